@@ -0,0 +1,446 @@
+"""
+Offline CPU benchmark for inference.py.
+
+Replays images from datasets/merged_dataset/valid/images through every
+available backend (see inference.BACKENDS) and reports:
+
+  - cold start   : wall time of `python inference.py <image> --no-cache`, i.e.
+                   interpreter + imports + model load + first analyze_image
+  - latency      : p50/p95/p99 of single-image analyze() with a warm model
+  - throughput   : images/sec of analyze_batch at several batch sizes
+  - threads      : all of the above per intra-op thread count
+  - peak RSS     : max resident memory of the measuring process
+  - startup      : `python -X importtime` breakdown of importing inference.py
+                   and then the ML stack (ultralytics/torch, loaded lazily on the
+                   first model load), and the wall time of a CLI run that rejects
+                   an invalid (too bright) image before that stack is imported
+
+Each (backend, threads) combination runs in its own subprocess, so thread
+settings take effect before torch/onnxruntime start and RSS is not shared.
+Results go to a JSON file (with the git commit) for comparison across commits.
+
+With --validation it instead compares upload validation: the old full
+decode + mean brightness against validate_image's header probe and reduced
+decode, on the valid split, the backend's test images/uploads and synthetic
+12 MP phone photos, checking that every accept/reject decision matches.
+
+Usage:
+  python benchmark_inference.py [--backends torch onnx] [--threads 1 2 4] [--batch-sizes 1 4 8]
+                                [--limit 50] [--out runs/benchmarks/inference.json]
+  python benchmark_inference.py --validation [--limit 200]
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import zlib
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+VALID_DIR = os.path.join(SCRIPT_DIR, 'datasets', 'merged_dataset', 'valid', 'images')
+DEFAULT_OUT = os.path.join(SCRIPT_DIR, 'runs', 'benchmarks', 'inference.json')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def valid_images(limit=None):
+    paths = sorted(p for p in glob.glob(os.path.join(VALID_DIR, '*')) if p.lower().endswith(IMAGE_SUFFIXES))
+    return paths[:limit] if limit else paths
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def thread_env(threads):
+    env = dict(os.environ)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[var] = str(threads)
+    return env
+
+
+def cold_start(backend, threads, image):
+    """Wall time of one fresh `inference.py <image>` process (what the backend used to spawn per upload)."""
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, 'inference.py'), image, '--no-cache', '--backend', backend]
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True, env=thread_env(threads))
+    elapsed = time.perf_counter() - start
+    ok = proc.returncode == 0 and '"success"' in proc.stdout
+    return round(elapsed, 3) if ok else None
+
+
+def parse_importtime(stderr, top=12):
+    """
+    Cumulative import time (ms) of each top-level module from `python -X importtime`
+    output, largest first (only the `top` largest are kept).
+    """
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # header line
+        name = fields[2][1:]
+        if name.startswith(' '):
+            continue  # imported by another module, already inside its parent's cumulative time
+        totals[name] = totals.get(name, 0) + int(fields[1]) / 1000
+    ranked = sorted(totals.items(), key=lambda kv: -kv[1])[:top]
+    return {name: round(ms, 1) for name, ms in ranked}
+
+
+def import_breakdown():
+    """Import-time breakdown of `import inference` and of the lazily imported ML stack."""
+    code = ("import time; t = time.perf_counter(); import inference; t1 = time.perf_counter(); "
+            "import ultralytics; t2 = time.perf_counter(); "
+            "print(round((t1 - t) * 1000, 1), round((t2 - t1) * 1000, 1))")
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SCRIPT_DIR,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]}
+    inference_ms, ml_stack_ms = map(float, proc.stdout.split())
+    return {
+        'import_inference_ms': inference_ms,
+        'import_ml_stack_ms': ml_stack_ms,
+        'modules_ms': parse_importtime(proc.stderr),
+    }
+
+
+def bright_png(path, size=64):
+    """Write a plain white PNG (what validate_image rejects) without needing cv2 in this process."""
+    raw = b''.join(b'\x00' + b'\xff' * size * 3 for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw)))
+        f.write(chunk(b'IEND', b''))
+
+
+def reject_time(runs=3):
+    """Best-of-N wall time of `python inference.py <bright image>`, which must fail validation."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bright.png')
+        bright_png(path)
+        cmd = [sys.executable, os.path.join(SCRIPT_DIR, 'inference.py'), path, '--no-cache']
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+            times.append(time.perf_counter() - start)
+            if '"error"' not in proc.stdout:
+                return None
+    return round(min(times), 3)
+
+
+def phone_photos(directory, size=(4032, 3024)):
+    """Write a dark (grains on black) and a bright (screenshot-like) 12 MP JPEG; returns their paths."""
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(0)
+    w, h = size
+    dark = rng.integers(0, 30, size=(h, w, 3), dtype=np.uint8)
+    for _ in range(400):
+        center = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+        cv2.ellipse(dark, center, (60, 20), float(rng.integers(0, 180)), 0, 360, (200, 210, 220), -1)
+    bright = np.clip(dark.astype(np.int16) + 190, 0, 255).astype(np.uint8)
+    paths = []
+    for name, img in (("phone_dark.jpg", dark), ("phone_bright.jpg", bright)):
+        path = os.path.join(directory, name)
+        cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        paths.append(path)
+    return paths
+
+
+def benchmark_validation(limit=200, repeats=3):
+    """The baseline validate_image (full decode) vs the current one (header probe + reduced decode)."""
+    import cv2
+    import numpy as np
+    import inference
+
+    def baseline_validate_image(image_path):
+        # validate_image as it was before the header probe, copied verbatim
+        try:
+            img = cv2.imread(image_path)
+            if img is None:
+                return False, "Could not read image file"
+
+            # Check average brightness
+            # Rice grains on black background should result in low average brightness
+            # Random screenshots usually have high brightness (white/light background)
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            mean_brightness = np.mean(gray)
+
+            # Threshold: 100 out of 255.
+            # Screenshots are typically > 150-200. Dark background images are < 50.
+            if mean_brightness > 100:
+                return False, "Invalid image: Image is too bright. Please use an image with a dark background."
+
+            return True, None
+        except Exception as e:
+            return False, f"Validation error: {str(e)}"
+
+    def old_check(path):
+        return baseline_validate_image(path)[0]
+
+    def timed(fn, path):
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn(path)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
+
+    backend_dir = os.path.join(SCRIPT_DIR, '..', 'backend')
+    groups = {
+        'valid_split': valid_images(limit),
+        'backend_images': sorted(glob.glob(os.path.join(backend_dir, '*.png'))
+                                 + glob.glob(os.path.join(backend_dir, 'uploads', '*'))),
+    }
+    report = {'mismatches': [], 'groups': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        groups['phone_12mp'] = phone_photos(tmp)
+        for group, paths in groups.items():
+            old_ms, new_ms, rejected = [], [], 0
+            for path in paths:
+                old_ok, old_t = timed(old_check, path)
+                (new_ok, error), new_t = timed(inference.validate_image, path)
+                old_ms.append(old_t)
+                new_ms.append(new_t)
+                rejected += not new_ok
+                if old_ok != new_ok:
+                    report['mismatches'].append({'image': path, 'old': old_ok, 'new': new_ok, 'error': error})
+            if not paths:
+                continue
+            report['groups'][group] = {
+                'images': len(paths),
+                'rejected': rejected,
+                'old_median_ms': round(float(np.median(old_ms)), 2),
+                'new_median_ms': round(float(np.median(new_ms)), 2),
+            }
+        # The case the fast path is for: rejecting a large bright photo
+        bright = groups['phone_12mp'][1]
+        _, full = timed(old_check, bright)
+        _, quick = timed(inference.quick_reject, bright)
+        report['phone_reject_ms'] = {'full_decode': round(full, 2), 'quick_reject': round(quick, 2),
+                                     'speedup': round(full / quick, 1)}
+
+    print("=" * 60)
+    print("UPLOAD VALIDATION: full decode vs header probe + reduced decode")
+    print("=" * 60)
+    for group, row in report['groups'].items():
+        print(f"{group:<16}{row['images']:>5} images | {row['rejected']:>4} rejected | "
+              f"old {row['old_median_ms']:>8} ms | new {row['new_median_ms']:>8} ms (median)")
+    phone = report['phone_reject_ms']
+    print(f"Reject 12 MP bright photo: {phone['full_decode']} ms -> {phone['quick_reject']} ms (x{phone['speedup']})")
+    print(f"Decision mismatches: {len(report['mismatches'])}")
+    for mismatch in report['mismatches'][:10]:
+        print(f"  {mismatch}")
+    return report
+
+
+def measure(backend, threads, images, batch_sizes, repeats):
+    """Runs inside the child process: warm latency, batch throughput and peak RSS for one config."""
+    import inference
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    inference.BACKEND = backend
+    start = time.perf_counter()
+    model = inference.get_model()
+    load_s = time.perf_counter() - start
+
+    # Decode once up front so only the analyze pipeline is timed
+    decoded = []
+    for path in images:
+        img, error = inference.load_image(path)
+        if img is not None:
+            decoded.append(img)
+    if not decoded:
+        raise RuntimeError("No readable images to benchmark")
+
+    start = time.perf_counter()
+    inference.run_model(model, [decoded[0]])
+    first_s = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(repeats):
+        for img in decoded:
+            start = time.perf_counter()
+            inference.analyze(img, image_name='bench', use_cache=False)
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    throughput = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            inference.analyze_batch(decoded, batch_size=batch_size, use_cache=False)
+        elapsed = time.perf_counter() - start
+        throughput[str(batch_size)] = round(len(decoded) * repeats / elapsed, 2)
+
+    return {
+        'backend': backend,
+        'threads': threads,
+        'images': len(decoded),
+        'model_load_s': round(load_s, 3),
+        'first_inference_s': round(first_s, 3),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'mean': round(sum(latencies) / len(latencies), 2),
+        },
+        'images_per_sec': throughput,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_config(backend, threads, args):
+    """Measure one (backend, threads) config in a fresh subprocess."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', '--backends', backend,
+           '--threads', str(threads), '--limit', str(args.limit), '--repeats', str(args.repeats),
+           '--batch-sizes', *map(str, args.batch_sizes)]
+    proc = subprocess.run(cmd, capture_output=True, text=True, env=thread_env(threads))
+    lines = [l for l in proc.stdout.splitlines() if l.startswith('{')]
+    if proc.returncode != 0 or not lines:
+        return {'backend': backend, 'threads': threads, 'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(lines[-1])
+
+
+def available_backends():
+    import inference
+    return [name for name, path in inference.BACKENDS.items() if os.path.exists(path)]
+
+
+def print_table(results, batch_sizes):
+    print("\n" + "=" * 60)
+    header = f"{'backend':<14}{'thr':>4}{'cold s':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'RSS MB':>8}"
+    header += ''.join(f"{'bs' + str(b):>8}" for b in batch_sizes)
+    print(header)
+    for r in results:
+        if 'error' in r:
+            print(f"{r['backend']:<14}{r['threads']:>4}  error: {r['error']}")
+            continue
+        lat = r['latency_ms']
+        row = f"{r['backend']:<14}{r['threads']:>4}{str(r.get('cold_start_s')):>8}{lat['p50']:>8}{lat['p95']:>8}{lat['p99']:>8}{r['peak_rss_mb']:>8}"
+        row += ''.join(f"{r['images_per_sec'][str(b)]:>8}" for b in batch_sizes)
+        print(row)
+    print("=" * 60)
+    print("latency in ms per image, throughput columns in images/sec at each batch size")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark inference.py latency and throughput on the valid split.")
+    parser.add_argument('--backends', nargs='+', default=None, help="Default: every backend with exported weights")
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, os.cpu_count() or 1])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 8, 16])
+    parser.add_argument('--limit', type=int, default=50, help="Number of valid images to replay")
+    parser.add_argument('--repeats', type=int, default=1, help="Passes over the images per measurement")
+    parser.add_argument('--no-cold-start', action='store_true', help="Skip the fresh-process cold start timing")
+    parser.add_argument('--out', default=DEFAULT_OUT, help="JSON results path")
+    parser.add_argument('--validation', action='store_true',
+                        help="Benchmark upload validation (full decode vs reduced decode) instead of inference")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    images = valid_images(args.limit)
+
+    if args.validation:
+        report = benchmark_validation(args.limit)
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        out = args.out if args.out != DEFAULT_OUT else os.path.join(os.path.dirname(DEFAULT_OUT), 'validation.json')
+        with open(out, 'w') as f:
+            json.dump({'commit': git_commit(), **report}, f, indent=2)
+        print(f"Results written to {out}")
+        sys.exit(1 if report['mismatches'] else 0)
+
+    if args.child:
+        print(json.dumps(measure(args.backends[0], args.threads[0], images, args.batch_sizes, args.repeats)))
+        return
+
+    if not images:
+        print(f"No images found in {VALID_DIR}")
+        sys.exit(1)
+    backends = args.backends or available_backends()
+    threads = sorted(set(args.threads))
+
+    print("=" * 60)
+    print("RICE QUALITY INFERENCE BENCHMARK")
+    print("=" * 60)
+    print(f"Images: {len(images)} from {VALID_DIR}")
+    print(f"Backends: {', '.join(backends)}")
+    print(f"Threads: {threads} | Batch sizes: {args.batch_sizes}")
+    print("=" * 60)
+
+    results = []
+    for backend in backends:
+        for n in threads:
+            print(f"Running {backend} with {n} thread(s)...")
+            result = run_config(backend, n, args)
+            if not args.no_cold_start and 'error' not in result:
+                result['cold_start_s'] = cold_start(backend, n, images[0])
+            results.append(result)
+
+    print_table(results, args.batch_sizes)
+
+    startup = import_breakdown()
+    startup['reject_invalid_image_s'] = reject_time()
+    print(f"Startup: import inference {startup.get('import_inference_ms')} ms, "
+          f"ML stack (lazy) {startup.get('import_ml_stack_ms')} ms, "
+          f"invalid image rejected in {startup['reject_invalid_image_s']} s")
+    for name, ms in startup.get('modules_ms', {}).items():
+        print(f"  {name:<24}{ms:>10} ms")
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                    'cpu_count': os.cpu_count(), 'python': platform.python_version()},
+        'images': len(images),
+        'repeats': args.repeats,
+        'startup': startup,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Class-balance and box statistics for merged_dataset, computed on packed labels.
+
+Loads <split>/labels.npz (written by merge_datasets.py, see label_store.py;
+falls back to packing the split's .txt labels) and computes everything with
+array operations over all boxes at once:
+
+  - per-class box counts, per split and per source (gen / rq3 / crg)
+  - boxes per image (mean, percentiles, empty images)
+  - box size (sqrt(w*h)) and aspect ratio (w/h) histograms per class
+  - Broken share per split/source and train/valid imbalance
+
+Prints a compact summary and writes JSON. Exits non-zero with --fail-on-empty
+when a split has no boxes, so it can gate a CI training job.
+
+Usage:
+  python dataset_stats.py [--dataset datasets/merged_dataset] [--json stats.json]
+"""
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from label_store import LabelStore, STORE_NAME
+
+CLASS_NAMES = ["Full", "Broken"]
+SOURCES = ["gen", "rq3", "crg"]
+SIZE_BINS = [0.0, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 1.0]  # sqrt(w*h), normalized
+ASPECT_BINS = [0.0, 0.25, 0.5, 0.8, 1.25, 2.0, 4.0, np.inf]  # w / h
+
+
+def load_split(dataset_dir: Path, split: str):
+    path = dataset_dir / split / STORE_NAME
+    if path.exists():
+        return LabelStore.load(path)
+    return LabelStore.from_yolo_dir(dataset_dir / split / "labels")
+
+
+def histogram(values, bins):
+    counts, _ = np.histogram(values, bins=bins)
+    labels = [f"{lo:g}-{hi:g}" for lo, hi in zip(bins[:-1], bins[1:])]
+    return dict(zip(labels, counts.tolist()))
+
+
+def class_breakdown(counts: np.ndarray):
+    """counts: (nc,) box counts -> dict with per-class counts and Broken share."""
+    total = int(counts.sum())
+    out = {name: int(c) for name, c in zip(CLASS_NAMES, counts)}
+    out["total"] = total
+    out["broken_fraction"] = round(float(counts[1]) / total, 4) if total else None
+    return out
+
+
+def split_stats(store: LabelStore):
+    nc = len(CLASS_NAMES)
+    per_image = store.class_counts(nc)  # (M, nc)
+    boxes_per_image = per_image.sum(axis=1)
+
+    # Source of every image from its stem prefix, vectorized over the stem array
+    source_of_image = np.full(len(store), "other", dtype=object)
+    for source in SOURCES:
+        source_of_image[np.char.startswith(store.stems, f"{source}_")] = source
+
+    sources = {}
+    for source in SOURCES + ["other"]:
+        mask = source_of_image == source
+        if mask.any():
+            sources[source] = {"images": int(mask.sum()), **class_breakdown(per_image[mask].sum(axis=0))}
+
+    w, h = store.boxes[:, 2], store.boxes[:, 3]
+    size = np.sqrt(np.clip(w * h, 0, None))
+    aspect = np.divide(w, h, out=np.full_like(w, np.inf), where=h > 0)
+    shapes = {}
+    for c, name in enumerate(CLASS_NAMES):
+        mask = store.cls == c
+        shapes[name] = {
+            "size_median": round(float(np.median(size[mask])), 4) if mask.any() else None,
+            "size_hist": histogram(size[mask], SIZE_BINS),
+            "aspect_hist": histogram(aspect[mask], ASPECT_BINS),
+        }
+
+    return {
+        "images": len(store),
+        "empty_images": int((boxes_per_image == 0).sum()),
+        "classes": class_breakdown(per_image.sum(axis=0)),
+        "boxes_per_image": {
+            "mean": round(float(boxes_per_image.mean()), 2) if len(store) else 0,
+            "p50": int(np.percentile(boxes_per_image, 50)) if len(store) else 0,
+            "p95": int(np.percentile(boxes_per_image, 95)) if len(store) else 0,
+            "max": int(boxes_per_image.max()) if len(store) else 0,
+        },
+        "sources": sources,
+        "shapes": shapes,
+    }
+
+
+def dataset_stats(dataset_dir, splits=("train", "valid")):
+    dataset_dir = Path(dataset_dir)
+    start = time.perf_counter()
+    stats = {"dataset": str(dataset_dir), "splits": {}}
+    for split in splits:
+        stats["splits"][split] = split_stats(load_split(dataset_dir, split))
+
+    fractions = [s["classes"]["broken_fraction"] for s in stats["splits"].values()]
+    images = [s["images"] for s in stats["splits"].values()]
+    stats["imbalance"] = {
+        # Gap in Broken share between splits: large values mean valid mAP won't reflect train
+        "broken_fraction_gap": round(max(fractions) - min(fractions), 4) if None not in fractions else None,
+        "split_fractions": {split: round(n / sum(images), 4) if sum(images) else None
+                            for split, n in zip(stats["splits"], images)},
+    }
+    stats["seconds"] = round(time.perf_counter() - start, 4)
+    return stats
+
+
+def print_summary(stats):
+    print("=" * 60)
+    print(f"DATASET STATS: {stats['dataset']}")
+    print("=" * 60)
+    for split, s in stats["splits"].items():
+        c = s["classes"]
+        bpi = s["boxes_per_image"]
+        print(f"{split:<6} {s['images']:>6} images ({s['empty_images']} empty) | "
+              f"Full {c['Full']:>7} | Broken {c['Broken']:>7} | broken {c['broken_fraction']}")
+        print(f"       boxes/image mean {bpi['mean']} p50 {bpi['p50']} p95 {bpi['p95']} max {bpi['max']}")
+        for source, src in s["sources"].items():
+            print(f"       {source:<5} {src['images']:>6} images | Full {src['Full']:>7} | "
+                  f"Broken {src['Broken']:>7} | broken {src['broken_fraction']}")
+    imbalance = stats["imbalance"]
+    print(f"Broken share gap between splits: {imbalance['broken_fraction_gap']}")
+    print(f"Split fractions: {imbalance['split_fractions']}")
+    print(f"Computed in {stats['seconds'] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized class-balance and box statistics for a YOLO dataset.")
+    parser.add_argument("--dataset", default=str(Path(__file__).parent / "datasets" / "merged_dataset"))
+    parser.add_argument("--json", default=None, help="Also write the full stats JSON to this path")
+    parser.add_argument("--quiet", action="store_true", help="Skip the text summary")
+    parser.add_argument("--fail-on-empty", action="store_true", help="Exit 1 if any split has no boxes")
+    args = parser.parse_args()
+
+    stats = dataset_stats(args.dataset)
+    if not args.quiet:
+        print_summary(stats)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(stats, f, indent=2)
+    if args.fail_on_empty and any(s["classes"]["total"] == 0 for s in stats["splits"].values()):
+        print("Error: a split has no labeled boxes", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""
+Distill the rice_quality_v3 YOLOv8-Small model into a YOLOv8-Nano student for CPU serving.
+
+Every production request runs on CPU, where yolov8n is several times faster
+than yolov8s. This script trains the nano model on what the teacher knows and
+then measures whether it is good enough to serve:
+
+  1. Pseudo-labels (optional)
+     --pseudo-scenes N   renders N synthetic scenes with generate_data.render_scene
+                         and labels them with the teacher's detections
+     --teacher-labels    replaces the merged train labels with the teacher's
+                         detections (hard-label distillation) instead of the
+                         hand labels
+  2. Student training    yolov8n.pt on merged train (+ pseudo-labeled scenes),
+                         same recipe as train_v3.py, into runs/detect/rice_quality_nano
+  3. Comparison report   teacher vs student on the merged valid split:
+                         mAP50 / mAP50-95, Full/Broken counting error against the
+                         ground-truth labels, CPU latency (p50/p95, batch 1) and
+                         weights size -> runs/distill/report.json
+
+Distillation is done through the teacher's labels (pseudo-labeling); ultralytics
+has no logit-level distillation loss to hook into without patching its trainer.
+
+The student is served with:  RICE_INFERENCE_BACKEND=torch-nano python inference.py <image>
+
+Usage:
+  python distill.py [--epochs 100] [--pseudo-scenes 500] [--teacher-labels]
+  python distill.py --report-only
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+from pathlib import Path
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+import generate_data
+import inference
+from label_store import LabelStore, STORE_NAME
+from dataset_stats import load_split
+from train_v3 import fix_data_yaml
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+MERGED_DIR = os.path.join(BASE, 'datasets', 'merged_dataset')
+DISTILL_DIR = os.path.join(BASE, 'datasets', 'distill_dataset')
+STUDENT_NAME = 'rice_quality_nano'
+TEACHER_WEIGHTS = inference.BACKENDS['torch']
+STUDENT_WEIGHTS = inference.BACKENDS['torch-nano']
+REPORT_PATH = os.path.join(BASE, 'runs', 'distill', 'report.json')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+PSEUDO_CONF = 0.5  # teacher detections below this are not used as labels
+
+
+def image_paths(images_dir):
+    return sorted(os.path.join(images_dir, f) for f in os.listdir(images_dir) if f.lower().endswith(IMAGE_SUFFIXES))
+
+
+def predict(model, sources, conf, device='cpu'):
+    """model.predict with ultralytics logging kept off stdout; one Result per source."""
+    inference.quiet_ultralytics()
+    return model.predict(sources, conf=conf, device=device, batch=len(sources), save=False, verbose=False)
+
+
+def teacher_labels(teacher, sources, conf=PSEUDO_CONF):
+    """(cls (n,), boxes (n, 4) normalized xywh) of the teacher's detections for each source."""
+    labels = []
+    for start in range(0, len(sources), inference.DEFAULT_BATCH_SIZE):
+        for result in predict(teacher, sources[start:start + inference.DEFAULT_BATCH_SIZE], conf):
+            boxes = result.boxes
+            labels.append((boxes.cls.cpu().numpy().astype(np.int16), boxes.xywhn.cpu().numpy()))
+    return labels
+
+
+def link_images(paths, images_dir):
+    """Expose existing images under images_dir (symlinks, copied where links are not supported)."""
+    os.makedirs(images_dir, exist_ok=True)
+    for path in paths:
+        target = os.path.join(images_dir, os.path.basename(path))
+        if os.path.lexists(target):
+            continue
+        try:
+            os.symlink(path, target)
+        except OSError:
+            cv2.imwrite(target, cv2.imread(path))
+
+
+def write_labels(split_dir, stems, labels):
+    store = LabelStore.from_items((stem, c, b) for stem, (c, b) in zip(stems, labels))
+    store.to_yolo_dir(os.path.join(split_dir, 'labels'))
+    store.save(os.path.join(split_dir, STORE_NAME))
+    return store
+
+
+def relabel_train(teacher, conf):
+    """Merged train images with the teacher's detections as labels (datasets/distill_dataset/teacher_train)."""
+    split_dir = os.path.join(DISTILL_DIR, 'teacher_train')
+    paths = image_paths(os.path.join(MERGED_DIR, 'train', 'images'))
+    link_images(paths, os.path.join(split_dir, 'images'))
+    store = write_labels(split_dir, [os.path.splitext(os.path.basename(p))[0] for p in paths],
+                         teacher_labels(teacher, paths, conf))
+    print(f"Teacher-labeled {len(store)} train images ({store.num_boxes} boxes)")
+    return os.path.join(split_dir, 'images')
+
+
+def pseudo_label_scenes(teacher, num_scenes, grains_per_image, seed, conf, source_dir):
+    """
+    Render synthetic scenes and label them with the teacher (datasets/distill_dataset/pseudo_scenes).
+    The generator's own labels are only used to report how far the teacher's
+    counts are from them, a check that the pseudo-labels are trustworthy.
+    """
+    atlas = generate_data.build_atlas(generate_data.load_source_images(source_dir))
+    if not atlas:
+        print(f"No source grains in {source_dir}, skipping pseudo-labeled scenes")
+        return None, None
+
+    split_dir = os.path.join(DISTILL_DIR, 'pseudo_scenes')
+    images_dir = os.path.join(split_dir, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    scratch = generate_data.CompositeScratch()
+    stems, labels, count_error = [], [], []
+    for start in range(0, num_scenes, inference.DEFAULT_BATCH_SIZE):
+        scenes, rendered = [], []
+        for i in range(start, min(start + inference.DEFAULT_BATCH_SIZE, num_scenes)):
+            random.seed(generate_data.scene_seed(seed, i))
+            canvas, generated = generate_data.render_scene(atlas, grains_per_image, scratch=scratch)
+            stem = f"pseudo_{i}"
+            cv2.imwrite(os.path.join(images_dir, stem + '.jpg'), canvas, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            stems.append(stem)
+            scenes.append(canvas)
+            rendered.append(generated)
+        for (cls, boxes), generated in zip(teacher_labels(teacher, scenes, conf), rendered):
+            labels.append((cls, boxes))
+            count_error.append(abs(len(cls) - len(generated)))
+
+    store = write_labels(split_dir, stems, labels)
+    stats = {
+        'scenes': len(store),
+        'boxes': store.num_boxes,
+        'teacher_vs_generator_count_mae': round(float(np.mean(count_error)), 3),
+    }
+    print(f"Pseudo-labeled {stats['scenes']} synthetic scenes ({stats['boxes']} boxes, "
+          f"teacher vs generator count MAE {stats['teacher_vs_generator_count_mae']})")
+    return images_dir, stats
+
+
+def write_data_yaml(train_dirs):
+    """data.yaml training on train_dirs and validating on the merged valid split."""
+    data_yaml = os.path.join(DISTILL_DIR, 'data.yaml')
+    os.makedirs(DISTILL_DIR, exist_ok=True)
+    train = "\n".join(f"  - {d}" for d in train_dirs)
+    with open(data_yaml, 'w') as f:
+        f.write(f"""train:
+{train}
+val: {os.path.join(MERGED_DIR, 'valid', 'images')}
+
+nc: 2
+names:
+  0: Full
+  1: Broken
+""")
+    return data_yaml
+
+
+def train_student(data_yaml, args):
+    model = YOLO('yolov8n.pt')
+    model.train(
+        data=data_yaml,
+        epochs=args.epochs,
+        imgsz=args.imgsz,
+        batch=args.batch,
+        workers=args.workers,
+        patience=30,
+        name=STUDENT_NAME,
+        project=os.path.join(BASE, 'runs/detect'),
+        exist_ok=True,       # inference.BACKENDS['torch-nano'] expects this run directory
+        pretrained=True,
+        optimizer='AdamW',
+        lr0=1e-3,
+        lrf=0.01,
+
+        # Same augmentation as train_v3.py
+        mosaic=1.0,
+        mixup=0.1,
+        copy_paste=0.1,
+        degrees=180,
+        scale=0.5,
+        flipud=0.5,
+        fliplr=0.5,
+
+        plots=True,
+        save=True,
+        val=True,
+    )
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def evaluate(weights, data_yaml, paths, truth, repeats=1):
+    """
+    mAP, counting error against ground truth and CPU latency of one model on
+    the valid split, or None when no valid image passes inference.load_image.
+    """
+    images = []
+    for path in paths:
+        img, error = inference.load_image(path)
+        if img is not None:
+            images.append((os.path.splitext(os.path.basename(path))[0], img))
+    if not images:
+        print(f"  no valid-split image passed validation ({len(paths)} tried), skipping")
+        return None
+
+    inference.quiet_ultralytics()
+    model = YOLO(weights, task='detect')
+    metrics = model.val(data=data_yaml, split='val', device='cpu', plots=False, verbose=False)
+    predict(model, [images[0][1]], inference.CONF_THRESHOLD)  # warm-up
+
+    latencies, errors = [], []
+    for stem, img in images:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = predict(model, [img], inference.CONF_THRESHOLD)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+        output = inference.summarize(result, None)
+        labels = truth.get(stem)
+        if labels is None:
+            continue
+        true_full = int((labels[0] == 0).sum())
+        true_broken = int((labels[0] == 1).sum())
+        true_score = round(true_full / (true_full + true_broken) * 100, 2) if true_full + true_broken else 0.0
+        errors.append((abs(output['total_grains'] - true_full - true_broken),
+                       abs(output['good_grains'] - true_full),
+                       abs(output['broken_grains'] - true_broken),
+                       abs(output['quality_score'] - true_score)))
+
+    errors = np.array(errors, dtype=np.float64).reshape(-1, 4)
+    return {
+        'weights': weights,
+        'weights_mb': round(os.path.getsize(weights) / 1e6, 2),
+        'map50': round(float(metrics.box.map50), 4),
+        'map50_95': round(float(metrics.box.map), 4),
+        'images': len(images),
+        'count_mae_total': round(float(errors[:, 0].mean()), 3) if len(errors) else None,
+        'count_mae_full': round(float(errors[:, 1].mean()), 3) if len(errors) else None,
+        'count_mae_broken': round(float(errors[:, 2].mean()), 3) if len(errors) else None,
+        'quality_score_mae': round(float(errors[:, 3].mean()), 3) if len(errors) else None,
+        'cpu_latency_p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'cpu_latency_p95_ms': round(float(np.percentile(latencies, 95)), 2),
+    }
+
+
+def compare(args, pseudo_stats=None):
+    data_yaml = fix_data_yaml(BASE)
+    paths = image_paths(os.path.join(MERGED_DIR, 'valid', 'images'))
+    if args.limit:
+        paths = paths[:args.limit]
+    truth = load_split(Path(MERGED_DIR), 'valid')
+
+    report = {'commit': git_commit(), 'pseudo_labels': pseudo_stats}
+    for name, weights in (('teacher', TEACHER_WEIGHTS), ('student', STUDENT_WEIGHTS)):
+        if not os.path.exists(weights):
+            print(f"{name}: {weights} not found, skipping")
+            continue
+        print(f"Evaluating {name} ({weights})...")
+        report[name] = evaluate(weights, data_yaml, paths, truth, args.repeats)
+
+    teacher, student = report.get('teacher'), report.get('student')
+    if teacher and student:
+        report['student_vs_teacher'] = {
+            'map50_drop': round(teacher['map50'] - student['map50'], 4),
+            'count_mae_increase': round(student['count_mae_total'] - teacher['count_mae_total'], 3),
+            'cpu_speedup': round(teacher['cpu_latency_p50_ms'] / student['cpu_latency_p50_ms'], 2),
+        }
+        delta = report['student_vs_teacher']
+        report['serve_student'] = (delta['map50_drop'] <= args.max_map_drop
+                                   and delta['count_mae_increase'] <= args.max_count_error_increase)
+
+    print("=" * 60)
+    print("DISTILLATION REPORT (merged valid split, CPU, batch 1)")
+    print("=" * 60)
+    print(f"{'':<10}{'mAP50':>8}{'mAP50-95':>10}{'count MAE':>11}{'broken MAE':>12}{'p50 ms':>9}{'p95 ms':>9}{'MB':>8}")
+    for name in ('teacher', 'student'):
+        row = report.get(name)
+        if row:
+            print(f"{name:<10}{row['map50']:>8}{row['map50_95']:>10}{row['count_mae_total']:>11}"
+                  f"{row['count_mae_broken']:>12}{row['cpu_latency_p50_ms']:>9}{row['cpu_latency_p95_ms']:>9}"
+                  f"{row['weights_mb']:>8}")
+    if 'student_vs_teacher' in report:
+        delta = report['student_vs_teacher']
+        print(f"Student: mAP50 -{delta['map50_drop']} | count MAE +{delta['count_mae_increase']} | "
+              f"x{delta['cpu_speedup']} faster on CPU")
+        if report['serve_student']:
+            print("Within tolerance: serve it with RICE_INFERENCE_BACKEND=torch-nano")
+        else:
+            print(f"Outside tolerance (mAP50 drop <= {args.max_map_drop}, "
+                  f"count MAE increase <= {args.max_count_error_increase}): keep serving the teacher")
+
+    os.makedirs(os.path.dirname(args.report), exist_ok=True)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+    return report
+
+
+def distill(args):
+    if not os.path.exists(TEACHER_WEIGHTS):
+        print(f"Teacher not found: {TEACHER_WEIGHTS} (train it with train_v3.py)")
+        sys.exit(1)
+    fix_data_yaml(BASE)
+
+    print("=" * 60)
+    print("RICE QUALITY DISTILLATION - YOLOv8-Small -> YOLOv8-Nano")
+    print("=" * 60)
+    print(f"Teacher: {TEACHER_WEIGHTS}")
+    print(f"Train labels: {'teacher detections' if args.teacher_labels else 'ground truth'} "
+          f"| Pseudo-labeled scenes: {args.pseudo_scenes} (conf >= {args.pseudo_conf})")
+    print(f"Student: yolov8n.pt -> {STUDENT_WEIGHTS}")
+    print("=" * 60)
+
+    teacher = inference.load_model(TEACHER_WEIGHTS)
+    train_dirs = [relabel_train(teacher, args.pseudo_conf) if args.teacher_labels
+                  else os.path.join(MERGED_DIR, 'train', 'images')]
+    pseudo_stats = None
+    if args.pseudo_scenes:
+        images_dir, pseudo_stats = pseudo_label_scenes(teacher, args.pseudo_scenes, args.grains_per_image,
+                                                       args.seed, args.pseudo_conf,
+                                                       os.path.join(BASE, args.source_dir))
+        if images_dir:
+            train_dirs.append(images_dir)
+    del teacher
+
+    train_student(write_data_yaml(train_dirs), args)
+    return compare(args, pseudo_stats)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distill rice_quality_v3 into a YOLOv8-Nano student and compare them.")
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=8, help="Dataloader worker processes")
+    parser.add_argument('--teacher-labels', action='store_true',
+                        help="Train on the teacher's detections for the merged train images instead of the hand labels")
+    parser.add_argument('--pseudo-scenes', type=int, default=0, help="Synthetic scenes to render and teacher-label")
+    parser.add_argument('--pseudo-conf', type=float, default=PSEUDO_CONF, help="Teacher confidence kept as a label")
+    parser.add_argument('--grains-per-image', type=int, default=generate_data.GRAINS_PER_IMAGE)
+    parser.add_argument('--seed', type=int, default=generate_data.SEED)
+    parser.add_argument('--source-dir', default=generate_data.SOURCE_DIR)
+    parser.add_argument('--report-only', action='store_true', help="Skip training; compare the existing teacher and student")
+    parser.add_argument('--limit', type=int, default=None, help="Report: only the first N valid images for counts/latency")
+    parser.add_argument('--repeats', type=int, default=3, help="Report: timed runs per image")
+    parser.add_argument('--max-map-drop', type=float, default=0.02, help="Report: largest acceptable mAP50 drop")
+    parser.add_argument('--max-count-error-increase', type=float, default=0.5,
+                        help="Report: largest acceptable increase in mean absolute grain-count error")
+    parser.add_argument('--report', default=REPORT_PATH)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.report_only:
+        compare(args)
+    else:
+        distill(args)
@@ -0,0 +1,241 @@
+"""
+Export the trained rice_quality_v3 weights for CPU serving and check parity.
+
+Formats (written next to the weights; for best.pt these are the paths
+inference.BACKENDS expects):
+  onnx           : best.onnx               (ONNX Runtime, dynamic batch)
+  onnx-int8      : best_int8.onnx          (ONNX Runtime, static INT8, calibrated on valid split)
+  openvino       : best_openvino_model/    (OpenVINO FP32)
+  openvino-int8  : best_int8_openvino_model/ (OpenVINO INT8, calibrated by ultralytics)
+
+The parity check runs every exported backend and the PyTorch weights they were
+exported from over the merged valid split and compares the Full/Broken counts
+per image, plus latency and weights size. It exits with status 1 when a
+backend's mean per-image Full or Broken count error exceeds --tolerance.
+Serve a backend with:  RICE_INFERENCE_BACKEND=onnx python inference.py <image>
+
+Requires: pip install onnx onnxruntime   (and openvino for the OpenVINO formats)
+"""
+
+import os
+import glob
+import json
+import time
+import sys
+import shutil
+import argparse
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+import inference
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+VALID_DIR = os.path.join(BASE, 'datasets', 'merged_dataset', 'valid', 'images')
+DATA_YAML = os.path.join(BASE, 'datasets', 'merged_dataset', 'data.yaml')
+IMGSZ = 640
+FORMATS = ['onnx', 'onnx-int8', 'openvino', 'openvino-int8']
+# Largest mean per-image Full or Broken count difference from PyTorch that passes parity
+PARITY_TOLERANCE = 0.5
+
+
+def export_paths(weights):
+    """Where each format of `weights` is written (ultralytics' naming, next to the .pt file)."""
+    stem = os.path.splitext(weights)[0]
+    return {
+        'onnx': stem + '.onnx',
+        'onnx-int8': stem + '_int8.onnx',
+        'openvino': stem + '_openvino_model',
+        'openvino-int8': stem + '_int8_openvino_model',
+    }
+
+
+def valid_images(limit=None):
+    paths = sorted(glob.glob(os.path.join(VALID_DIR, '*')))
+    paths = [p for p in paths if p.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp'))]
+    return paths[:limit] if limit else paths
+
+
+def letterbox(img, size=IMGSZ):
+    """Resize keeping aspect ratio and pad to size x size with gray (ultralytics default)."""
+    h, w = img.shape[:2]
+    r = min(size / h, size / w)
+    nh, nw = int(round(h * r)), int(round(w * r))
+    resized = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    out = np.full((size, size, 3), 114, dtype=np.uint8)
+    top, left = (size - nh) // 2, (size - nw) // 2
+    out[top:top + nh, left:left + nw] = resized
+    return out
+
+
+def to_input_tensor(img):
+    """BGR uint8 HWC -> RGB float32 NCHW in [0, 1], the layout the exported graph expects."""
+    x = letterbox(img)[:, :, ::-1].transpose(2, 0, 1)
+    return np.ascontiguousarray(x, dtype=np.float32)[None] / 255.0
+
+
+def export_onnx(weights):
+    model = YOLO(weights)
+    path = model.export(format='onnx', imgsz=IMGSZ, dynamic=True, simplify=True)
+    return str(path)
+
+
+def export_onnx_int8(onnx_path, out_path, calibration_images):
+    """Static INT8 quantization (QDQ) of the ONNX model with ONNX Runtime."""
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class ValidSplitReader(CalibrationDataReader):
+        def __init__(self, input_name, paths):
+            self.input_name = input_name
+            self.paths = iter(paths)
+
+        def get_next(self):
+            for path in self.paths:
+                img = cv2.imread(path)
+                if img is not None:
+                    return {self.input_name: to_input_tensor(img)}
+            return None
+
+    import onnxruntime as ort
+    input_name = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+    quantize_static(
+        onnx_path, out_path,
+        ValidSplitReader(input_name, calibration_images),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+    return out_path
+
+
+def export_openvino(weights, int8=False):
+    model = YOLO(weights)
+    path = model.export(format='openvino', imgsz=IMGSZ, int8=int8, data=DATA_YAML if int8 else None)
+    path = str(path)
+    target = export_paths(weights)['openvino-int8' if int8 else 'openvino']
+    if os.path.abspath(path) != os.path.abspath(target):
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.move(path, target)
+    return target
+
+
+def weights_size_mb(path):
+    if os.path.isdir(path):
+        total = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    else:
+        total = os.path.getsize(path)
+    return round(total / 1e6, 2)
+
+
+def run_counts(model_path, images):
+    """Per-image (full, broken) counts and per-image latency (ms) for one backend."""
+    model = inference.get_model(model_path)
+    # Warm up once so session/graph setup is not timed
+    inference.run_model(model, [images[0]])
+    counts, latencies = [], []
+    for img in images:
+        start = time.perf_counter()
+        result = inference.run_model(model, [img])[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        output = inference.summarize(result, None)
+        counts.append((output['good_grains'], output['broken_grains']))
+    return np.array(counts), np.array(latencies)
+
+
+def parity_check(weights, formats, limit=None, tolerance=PARITY_TOLERANCE):
+    """Compare each exported format of `weights` with the weights themselves; returns (report, failed formats)."""
+    paths = valid_images(limit)
+    images = []
+    for path in paths:
+        img, error = inference.load_image(path)
+        if img is not None:
+            images.append(img)
+    print(f"Parity check on {len(images)} valid images")
+
+    ref_counts, ref_lat = run_counts(weights, images)
+    report = {
+        'images': len(images),
+        'weights': weights,
+        'tolerance': tolerance,
+        'torch': {
+            'median_latency_ms': round(float(np.median(ref_lat)), 2),
+            'weights_mb': weights_size_mb(weights),
+        },
+    }
+
+    failed = []
+    paths = export_paths(weights)
+    for fmt in formats:
+        path = paths[fmt]
+        if not os.path.exists(path):
+            print(f"  {fmt}: not exported ({path})")
+            failed.append(fmt)
+            continue
+        counts, lat = run_counts(path, images)
+        total_err = np.abs(counts.sum(axis=1) - ref_counts.sum(axis=1))
+        class_err = np.abs(counts - ref_counts)
+        report[fmt] = {
+            'median_latency_ms': round(float(np.median(lat)), 2),
+            'speedup_vs_torch': round(float(np.median(ref_lat) / np.median(lat)), 2),
+            'weights_mb': weights_size_mb(path),
+            'exact_count_match': round(float(np.mean(class_err.sum(axis=1) == 0)), 4),
+            'mean_abs_total_error': round(float(total_err.mean()), 3),
+            'mean_abs_full_error': round(float(class_err[:, 0].mean()), 3),
+            'mean_abs_broken_error': round(float(class_err[:, 1].mean()), 3),
+        }
+        report[fmt]['within_tolerance'] = bool(class_err.mean(axis=0).max() <= tolerance)
+        if not report[fmt]['within_tolerance']:
+            failed.append(fmt)
+
+    print(json.dumps(report, indent=2))
+    return report, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export best.pt for CPU inference and check parity.")
+    parser.add_argument('--weights', default=inference.MODEL_PATH)
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['onnx', 'onnx-int8'])
+    parser.add_argument('--skip-export', action='store_true', help="Only run the parity check")
+    parser.add_argument('--no-parity', action='store_true', help="Only export")
+    parser.add_argument('--parity-limit', type=int, default=None, help="Use only the first N valid images")
+    parser.add_argument('--report', default=None, help="Also write the parity report JSON here")
+    parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE,
+                        help="Max mean per-image Full or Broken count error vs PyTorch")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("RICE QUALITY MODEL EXPORT")
+    print("=" * 60)
+    print(f"Weights: {args.weights}")
+    print(f"Formats: {', '.join(args.formats)}")
+    print("=" * 60)
+
+    if not args.skip_export:
+        onnx_path = None
+        if 'onnx' in args.formats or 'onnx-int8' in args.formats:
+            onnx_path = export_onnx(args.weights)
+            print(f"ONNX:          {onnx_path}")
+        if 'onnx-int8' in args.formats:
+            int8_path = export_paths(args.weights)['onnx-int8']
+            print(f"ONNX INT8:     {export_onnx_int8(onnx_path, int8_path, valid_images(limit=100))}")
+        if 'openvino' in args.formats:
+            print(f"OpenVINO:      {export_openvino(args.weights)}")
+        if 'openvino-int8' in args.formats:
+            print(f"OpenVINO INT8: {export_openvino(args.weights, int8=True)}")
+
+    if not args.no_parity:
+        report, failed = parity_check(args.weights, args.formats, limit=args.parity_limit, tolerance=args.tolerance)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+        if failed:
+            print(f"Parity FAILED (tolerance {args.tolerance}): {', '.join(failed)}")
+            sys.exit(1)
+        print("Parity OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,86 @@
 import os
 import random
+import argparse
 import cv2
 import numpy as np
 from glob import glob
+from multiprocessing import Pool
 from tqdm import tqdm
 
+from label_store import LabelStore, STORE_NAME
+
 # Configuration
 SOURCE_DIR = "datasets/source_grains"
 OUTPUT_DIR = "datasets/generated_train" # Overwrite the existing dataset folder for next training
 IMG_SIZE = 640
 NUM_IMAGES = 200  # Generate 200 synthetic images
 GRAINS_PER_IMAGE = 50 # Increased density (was 15)
+SEED = 42
+
+# Occlusion control (see OccupancyMap): no labeled grain may have more than this
+# fraction of its pixels covered by grains pasted after it. None disables it.
+MAX_OCCLUSION = 0.6
+PLACEMENT_ATTEMPTS = 6  # positions tried per grain before placing it anyway and dropping hidden labels
+
+# Drop shadow darkening under each grain (fraction of the background removed)
+SHADOW_OPACITY = 0.4
 
 # Classes
 CLASS_FULL = 0
 CLASS_BROKEN = 1
 
-def setup_dirs():
-    os.makedirs(f"{OUTPUT_DIR}/images", exist_ok=True)
-    os.makedirs(f"{OUTPUT_DIR}/labels", exist_ok=True)
+def setup_dirs(output_dir=OUTPUT_DIR):
+    os.makedirs(f"{output_dir}/images", exist_ok=True)
+    os.makedirs(f"{output_dir}/labels", exist_ok=True)
 
-def load_source_images():
+def load_source_images(source_dir=SOURCE_DIR):
     # Load all images from all subdirectories
-    images = glob(f"{SOURCE_DIR}/*/*.jpg") + glob(f"{SOURCE_DIR}/*/*.png")
+    images = glob(f"{source_dir}/*/*.jpg") + glob(f"{source_dir}/*/*.png")
     print(f"Found {len(images)} source grains.")
-    return images
+    return sorted(images)
 
-def create_broken_grain(img):
+def grain_mask(img):
+    """Binary mask (0/255) of the grain pixels: anything brighter than the black background."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, mask = cv2.threshold(gray, 10, 255, cv2.THRESH_BINARY)
+    return mask
+
+def build_atlas(source_grains):
+    """
+    Decode every source grain once and precompute its mask.
+    Returns a list of (image, mask) pairs shared by all scenes (and, via fork,
+    by all worker processes) instead of re-reading a file for every grain.
+    """
+    atlas = []
+    for path in source_grains:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        atlas.append((img, grain_mask(img)))
+    return atlas
+
+def create_broken_grain(img, mask=None):
     """
     Simulate a broken grain by cropping the original randomly.
+    If a mask is given it is cropped the same way and (img, mask) is returned.
     """
     h, w = img.shape[:2]
     # Keep 30% to 70% of the grain to simulate breakage
     crop_factor = random.uniform(0.3, 0.7)
-    
+
     if random.choice([True, False]):
         # Horizontal crop (keep top or bottom)
         new_h = int(h * crop_factor)
         start_y = 0 if random.choice([True, False]) else h - new_h
-        return img[start_y:start_y+new_h, :]
+        crop = (slice(start_y, start_y+new_h), slice(None))
     else:
         # Vertical crop (keep left or right)
         new_w = int(w * crop_factor)
         start_x = 0 if random.choice([True, False]) else w - new_w
-        return img[:, start_x:start_x+new_w]
+        crop = (slice(None), slice(start_x, start_x+new_w))
+    if mask is None:
+        return img[crop]
+    return img[crop], mask[crop]
 
 def add_shadow(canvas, mask, x, y, w, h):
     """
@@ -90,104 +127,399 @@ def add_shadow(canvas, mask, x, y, w, h):
     
     return canvas
 
-def generate_scene(image_id, source_grains):
+class CompositeScratch:
+    """
+    Reusable uint8 buffers for composite_grain, grown on demand, so pasting a
+    grain allocates nothing but its blurred shadow mask. One instance per
+    process/scene loop.
+    """
+
+    def __init__(self, size=128):
+        self._alloc(size)
+
+    def _alloc(self, size):
+        self.size = size
+        self.factor = np.empty((size, size), dtype=np.uint8)
+        self.factor3 = np.empty((size, size, 3), dtype=np.uint8)
+
+    def views(self, h, w):
+        if h > self.size or w > self.size:
+            self._alloc(max(h, w, self.size * 2))
+        return self.factor[:h, :w], self.factor3[:h, :w]
+
+def composite_grain(canvas, grain_img, mask, x, y, scratch):
+    """
+    Paste one grain (with its drop shadow) onto canvas in place.
+
+    Same result as add_shadow() followed by the bitwise_and/add paste, to
+    within 1 gray level per paste (the shadow factor is 8-bit and the product
+    is rounded, not truncated; where many shadows stack the gap can reach a
+    few levels). Every step is a single OpenCV call writing straight into a
+    view of the canvas, with no float temporaries and no per-grain numpy mask.
+    """
+    h, w = grain_img.shape[:2]
+    shadow_offset_x = random.randint(2, 5)
+    shadow_offset_y = random.randint(2, 5)
+
+    # Shadow: roi * (255 - opacity * blurred_mask) / 255, clipped to the canvas
+    sy1 = min(canvas.shape[0], y + shadow_offset_y)
+    sy2 = min(canvas.shape[0], y + h + shadow_offset_y)
+    sx1 = min(canvas.shape[1], x + shadow_offset_x)
+    sx2 = min(canvas.shape[1], x + w + shadow_offset_x)
+    if sy2 > sy1 and sx2 > sx1:
+        shadow_area = cv2.GaussianBlur(mask, (5, 5), 0)[:sy2 - sy1, :sx2 - sx1]
+        factor, factor3 = scratch.views(sy2 - sy1, sx2 - sx1)
+        cv2.addWeighted(shadow_area, -SHADOW_OPACITY, shadow_area, 0, 255, dst=factor)
+        cv2.merge([factor, factor, factor], dst=factor3)
+        roi_shadow = canvas[sy1:sy2, sx1:sx2]
+        cv2.multiply(roi_shadow, factor3, dst=roi_shadow, scale=1 / 255)
+
+    # Grain: copy grain pixels where the mask is set
+    roi = canvas[y:y+h, x:x+w]
+    cv2.copyTo(grain_img, mask, roi)
+
+def legacy_composite(canvas, grain_img, mask, x, y):
+    """Original per-grain compositing (add_shadow + bitwise paste), kept for benchmarking."""
+    h, w = grain_img.shape[:2]
+
+    # Add shadow first
+    canvas = add_shadow(canvas, mask, x, y, w, h)
+
+    # Region of Interest
+    roi = canvas[y:y+h, x:x+w]
+    mask_inv = cv2.bitwise_not(mask)
+
+    # Black-out area of grain in ROI
+    img_bg = cv2.bitwise_and(roi, roi, mask=mask_inv)
+    # Take only region of grain from grain_img
+    img_fg = cv2.bitwise_and(grain_img, grain_img, mask=mask)
+
+    # Put grain in ROI
+    dst = cv2.add(img_bg, img_fg)
+    canvas[y:y+h, x:x+w] = dst
+
+class OccupancyMap:
+    """
+    Which grain is on top at every pixel of a scene, for O(grain area) occlusion queries.
+
+    ids[y, x] is the 1-based index of the last grain pasted over that pixel
+    (0 = background). Placing a grain only reads and writes the ids under its
+    own mask, so a query costs the same with 1000 grains in the scene as with
+    10. Each grain's mask area and currently visible pixel count are kept, so
+    the covered fraction of every earlier grain is known after each paste.
+    """
+
+    def __init__(self, img_size, capacity, max_occlusion):
+        self.ids = np.zeros((img_size, img_size), dtype=np.int32)
+        self.area = np.zeros(capacity + 1, dtype=np.int64)
+        self.visible = np.zeros(capacity + 1, dtype=np.int64)
+        self.count = 0
+        self.max_occlusion = max_occlusion
+
+    def covered(self, mask, x, y):
+        """(grain ids, pixels of each) a grain with this mask at (x, y) would cover."""
+        h, w = mask.shape[:2]
+        under = self.ids[y:y+h, x:x+w][mask != 0]
+        return np.unique(under[under > 0], return_counts=True)
+
+    def violations(self, ids, lost):
+        """How many of these grains would end up covered beyond max_occlusion."""
+        limit = (1.0 - self.max_occlusion) * self.area[ids]
+        return int(np.count_nonzero(self.visible[ids] - lost < limit))
+
+    def place(self, mask, x, y, ids, lost):
+        h, w = mask.shape[:2]
+        self.count += 1
+        fg = mask != 0
+        self.ids[y:y+h, x:x+w][fg] = self.count
+        self.area[self.count] = self.visible[self.count] = np.count_nonzero(fg)
+        self.visible[ids] -= lost
+
+    def kept(self):
+        """Per placed grain (in paste order): is it visible enough to keep its label?"""
+        area, visible = self.area[1:self.count + 1], self.visible[1:self.count + 1]
+        return visible >= (1.0 - self.max_occlusion) * area
+
+def sample_position(clusters, w, h, img_size):
+    """Top-left corner for a w x h grain: 80% near a cluster center, 20% anywhere."""
+    if random.random() < 0.8:
+        # Pick a random cluster
+        cx, cy = random.choice(clusters)
+        # Offset from center (Gaussian dispersion) - make tightly packed
+        offset_x = int(random.gauss(0, 40))
+        offset_y = int(random.gauss(0, 40))
+        x_pos = max(0, min(img_size - w, cx + offset_x - w//2))
+        y_pos = max(0, min(img_size - h, cy + offset_y - h//2))
+    else:
+        # Random position (scattered grains)
+        x_pos = random.randint(0, img_size - w - 1)
+        y_pos = random.randint(0, img_size - h - 1)
+    return x_pos, y_pos
+
+def render_scene(atlas, grains_per_image=GRAINS_PER_IMAGE, img_size=IMG_SIZE, scratch=None, legacy=False,
+                 max_occlusion=MAX_OCCLUSION):
+    """
+    Composite one synthetic scene in memory.
+    Returns (canvas, labels) where labels is a list of
+    (class_id, x_center, y_center, width, height) in normalized YOLO format.
+    Uses the global `random` state, so seed it for reproducible scenes.
+    Pass a CompositeScratch to reuse buffers across scenes; legacy=True uses
+    the original compositing path (for benchmarking).
+
+    With max_occlusion set, each grain tries up to PLACEMENT_ATTEMPTS positions
+    for one that leaves every earlier grain at most that fraction covered
+    (checked on an OccupancyMap). If none does, the grain goes to the position
+    hiding the fewest grains, and grains left covered beyond the limit lose
+    their labels. Boxes are unchanged: kept grains keep their full extent.
+    max_occlusion=None places grains without any checks (the original behaviour).
+    """
+    scratch = scratch or CompositeScratch()
     # Create black canvas
-    canvas = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+    canvas = np.zeros((img_size, img_size, 3), dtype=np.uint8)
     labels = []
+    occupancy = OccupancyMap(img_size, grains_per_image, max_occlusion) if max_occlusion is not None else None
 
     # Cluster centers (create 3-5 piles of rice)
     num_clusters = random.randint(3, 5)
     clusters = []
     for _ in range(num_clusters):
-        cx = random.randint(100, IMG_SIZE-100)
-        cy = random.randint(100, IMG_SIZE-100)
+        cx = random.randint(100, img_size-100)
+        cy = random.randint(100, img_size-100)
         clusters.append((cx, cy))
 
-    for _ in range(GRAINS_PER_IMAGE):
+    for _ in range(grains_per_image):
         # Pick a random source grain
-        src_path = random.choice(source_grains)
-        src_img = cv2.imread(src_path)
-        
-        if src_img is None:
-            continue
+        src_img, src_mask = random.choice(atlas)
 
         # Decide if Full or Broken
-        is_broken = random.random() < 0.5 
+        is_broken = random.random() < 0.5
         class_id = CLASS_BROKEN if is_broken else CLASS_FULL
 
         if is_broken:
-            grain_img = create_broken_grain(src_img)
+            grain_img, mask = create_broken_grain(src_img, src_mask)
         else:
-            grain_img = src_img
+            grain_img, mask = src_img, src_mask
 
-        # Random rotation
+        # Random rotation (the precomputed mask is rotated with the grain)
         angle = random.randint(0, 360)
         M = cv2.getRotationMatrix2D((grain_img.shape[1]//2, grain_img.shape[0]//2), angle, 1.0)
         grain_img = cv2.warpAffine(grain_img, M, (grain_img.shape[1], grain_img.shape[0]))
-        
+        mask = cv2.warpAffine(mask, M, (mask.shape[1], mask.shape[0]), flags=cv2.INTER_NEAREST)
+
         # Slight blur to blend edges
         grain_img = cv2.GaussianBlur(grain_img, (3, 3), 0)
 
         h, w = grain_img.shape[:2]
-        if h >= IMG_SIZE or w >= IMG_SIZE: continue
+        if h >= img_size or w >= img_size: continue
 
         # Position logic: 80% chance to be near a cluster center, 20% random
-        if random.random() < 0.8:
-            # Pick a random cluster
-            cx, cy = random.choice(clusters)
-            # Offset from center (Gaussian dispersion) - make tightly packed
-            offset_x = int(random.gauss(0, 40))
-            offset_y = int(random.gauss(0, 40))
-            x_pos = max(0, min(IMG_SIZE - w, cx + offset_x - w//2))
-            y_pos = max(0, min(IMG_SIZE - h, cy + offset_y - h//2))
+        x_pos, y_pos = sample_position(clusters, w, h, img_size)
+        if occupancy is not None:
+            best = None
+            for attempt in range(PLACEMENT_ATTEMPTS):
+                if attempt:
+                    x_pos, y_pos = sample_position(clusters, w, h, img_size)
+                ids, lost = occupancy.covered(mask, x_pos, y_pos)
+                hidden = occupancy.violations(ids, lost)
+                if best is None or hidden < best[0]:
+                    best = (hidden, x_pos, y_pos, ids, lost)
+                if hidden == 0:
+                    break
+            _, x_pos, y_pos, ids, lost = best
+            occupancy.place(mask, x_pos, y_pos, ids, lost)
+
+        # Shadow + grain in one pass
+        if legacy:
+            legacy_composite(canvas, grain_img, mask, x_pos, y_pos)
         else:
-            # Random position (scattered grains)
-            x_pos = random.randint(0, IMG_SIZE - w - 1)
-            y_pos = random.randint(0, IMG_SIZE - h - 1)
-
-        # Create mask
-        gray = cv2.cvtColor(grain_img, cv2.COLOR_BGR2GRAY)
-        _, mask = cv2.threshold(gray, 10, 255, cv2.THRESH_BINARY)
-        
-        # Add shadow first
-        canvas = add_shadow(canvas, mask, x_pos, y_pos, w, h)
-
-        # Region of Interest
-        roi = canvas[y_pos:y_pos+h, x_pos:x_pos+w]
-        mask_inv = cv2.bitwise_not(mask)
-
-        # Black-out area of grain in ROI
-        img_bg = cv2.bitwise_and(roi, roi, mask=mask_inv)
-        # Take only region of grain from grain_img
-        img_fg = cv2.bitwise_and(grain_img, grain_img, mask=mask)
-
-        # Put grain in ROI
-        dst = cv2.add(img_bg, img_fg)
-        canvas[y_pos:y_pos+h, x_pos:x_pos+w] = dst
+            composite_grain(canvas, grain_img, mask, x_pos, y_pos, scratch)
 
         # Add label
-        x_center = (x_pos + w/2) / IMG_SIZE
-        y_center = (y_pos + h/2) / IMG_SIZE
-        norm_w = w / IMG_SIZE
-        norm_h = h / IMG_SIZE
-        
-        labels.append(f"{class_id} {x_center} {y_center} {norm_w} {norm_h}")
+        x_center = (x_pos + w/2) / img_size
+        y_center = (y_pos + h/2) / img_size
+        norm_w = w / img_size
+        norm_h = h / img_size
+
+        labels.append((class_id, x_center, y_center, norm_w, norm_h))
+
+    if occupancy is not None:
+        labels = [label for label, keep in zip(labels, occupancy.kept()) if keep]
+    return canvas, labels
+
+def generate_scene(image_id, atlas, output_dir=OUTPUT_DIR, grains_per_image=GRAINS_PER_IMAGE, scratch=None,
+                   max_occlusion=MAX_OCCLUSION):
+    canvas, labels = render_scene(atlas, grains_per_image, scratch=scratch, max_occlusion=max_occlusion)
 
     # Save Image
     params = [cv2.IMWRITE_JPEG_QUALITY, 95]
-    cv2.imwrite(f"{OUTPUT_DIR}/images/{image_id}.jpg", canvas, params)
+    cv2.imwrite(f"{output_dir}/images/{image_id}.jpg", canvas, params)
 
     # Save Label
-    with open(f"{OUTPUT_DIR}/labels/{image_id}.txt", "w") as f:
-        f.write("\n".join(labels))
+    with open(f"{output_dir}/labels/{image_id}.txt", "w") as f:
+        f.write("\n".join(f"{c} {x} {y} {w} {h}" for c, x, y, w, h in labels))
+    return labels
+
+# ── Parallel generation ──────────────────────────────────────────────────────
+# Worker processes get the atlas once through the pool initializer (copy-on-write
+# under fork) and seed `random` per image, so the output for a given --seed is
+# identical regardless of --workers.
+
+_worker_state = {}
+
+def _init_worker(atlas, output_dir, grains_per_image, max_occlusion):
+    _worker_state.update(atlas=atlas, output_dir=output_dir, grains_per_image=grains_per_image,
+                         max_occlusion=max_occlusion, scratch=CompositeScratch())
+
+def _generate_one(task):
+    index, seed = task
+    random.seed(seed)
+    labels = generate_scene(f"train_dense_{index}", _worker_state["atlas"],
+                            _worker_state["output_dir"], _worker_state["grains_per_image"],
+                            _worker_state["scratch"], _worker_state["max_occlusion"])
+    return index, np.array(labels, dtype=np.float32).reshape(-1, 5)
+
+def scene_seed(base_seed, index):
+    """Deterministic, well-spread seed for scene `index`."""
+    return (base_seed * 1_000_003 + index) & 0xFFFFFFFF
+
+def generate_dataset(atlas, num_images=NUM_IMAGES, workers=1, seed=SEED,
+                     output_dir=OUTPUT_DIR, grains_per_image=GRAINS_PER_IMAGE, max_occlusion=MAX_OCCLUSION):
+    import time
+    tasks = [(i, scene_seed(seed, i)) for i in range(num_images)]
+    results = {}
+    start = time.perf_counter()
+    if workers <= 1:
+        _init_worker(atlas, output_dir, grains_per_image, max_occlusion)
+        for task in tqdm(tasks):
+            index, labels = _generate_one(task)
+            results[index] = labels
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=(atlas, output_dir, grains_per_image, max_occlusion)) as pool:
+            for index, labels in tqdm(pool.imap_unordered(_generate_one, tasks, chunksize=8), total=len(tasks)):
+                results[index] = labels
+    elapsed = time.perf_counter() - start
+    labeled = sum(len(labels) for labels in results.values())
+    print(f"{num_images / elapsed:.2f} scenes/sec at {grains_per_image} grains/scene "
+          f"({labeled / max(num_images, 1):.1f} labeled grains/scene, max occlusion {max_occlusion})")
+
+    # Packed copy of all labels next to the .txt files (see label_store.py)
+    store = LabelStore.from_items(
+        (f"train_dense_{i}", results[i][:, 0], results[i][:, 1:]) for i in sorted(results)
+    )
+    store.save(os.path.join(output_dir, STORE_NAME))
+
+def synthetic_atlas(count=32, seed=SEED):
+    """Stand-in grains (bright ellipses) for benchmarking when no source grains are available."""
+    rng = np.random.default_rng(seed)
+    atlas = []
+    for _ in range(count):
+        length, width = int(rng.integers(40, 70)), int(rng.integers(12, 20))
+        img = np.zeros((length + 4, length + 4, 3), dtype=np.uint8)
+        color = tuple(int(c) for c in rng.integers(170, 240, size=3))
+        center = ((length + 4) // 2, (length + 4) // 2)
+        cv2.ellipse(img, center, (length // 2, width // 2), 0, 0, 360, color, -1)
+        atlas.append((img, grain_mask(img)))
+    return atlas
+
+def benchmark_compositing(atlas, densities=(50, 500), scenes=20, seed=SEED):
+    """
+    Time render_scene with the legacy compositing path against composite_grain,
+    on identical random draws, and report ms/scene and the max pixel difference.
+    Occlusion checks are off so only compositing differs between the two runs.
+    """
+    import time
+    scratch = CompositeScratch()
+    report = {}
+    for density in densities:
+        times = {}
+        max_diff = 0
+        for legacy in (True, False):
+            start = time.perf_counter()
+            for i in range(scenes):
+                random.seed(scene_seed(seed, i))
+                render_scene(atlas, density, scratch=scratch, legacy=legacy, max_occlusion=None)
+            times[legacy] = (time.perf_counter() - start) * 1000 / scenes
+        for i in range(min(scenes, 3)):
+            random.seed(scene_seed(seed, i))
+            a, _ = render_scene(atlas, density, legacy=True, max_occlusion=None)
+            random.seed(scene_seed(seed, i))
+            b, _ = render_scene(atlas, density, scratch=scratch, max_occlusion=None)
+            max_diff = max(max_diff, int(np.abs(a.astype(np.int16) - b).max()))
+        report[density] = {
+            "legacy_ms_per_scene": round(times[True], 2),
+            "kernel_ms_per_scene": round(times[False], 2),
+            "speedup": round(times[True] / times[False], 2),
+            "max_pixel_diff": max_diff,
+        }
+        print(f"GRAINS_PER_IMAGE={density:<5} legacy {times[True]:8.2f} ms/scene | "
+              f"kernel {times[False]:8.2f} ms/scene | x{times[True] / times[False]:.2f} | "
+              f"max pixel diff {max_diff}")
+    return report
+
+def benchmark_density(atlas, densities=(50, 200, 500, 1000), scenes=10, seed=SEED, max_occlusion=MAX_OCCLUSION):
+    """
+    Scenes/sec of render_scene at each grain density, with and without the
+    occupancy checks, plus how many grains keep their labels. ms per pasted
+    grain should stay roughly flat as density grows (no quadratic placement).
+    """
+    import time
+    scratch = CompositeScratch()
+    report = {}
+    for density in densities:
+        row = {}
+        for name, occlusion in (("unchecked", None), ("occupancy", max_occlusion)):
+            labeled = 0
+            start = time.perf_counter()
+            for i in range(scenes):
+                random.seed(scene_seed(seed, i))
+                _, labels = render_scene(atlas, density, scratch=scratch, max_occlusion=occlusion)
+                labeled += len(labels)
+            elapsed = time.perf_counter() - start
+            row[name] = {
+                "scenes_per_sec": round(scenes / elapsed, 2),
+                "ms_per_grain": round(elapsed * 1000 / (scenes * density), 4),
+                "labeled_per_scene": round(labeled / scenes, 1),
+            }
+        report[density] = row
+        checked = row["occupancy"]
+        print(f"GRAINS_PER_IMAGE={density:<5} unchecked {row['unchecked']['scenes_per_sec']:7.2f} scenes/s | "
+              f"occupancy {checked['scenes_per_sec']:7.2f} scenes/s, {checked['ms_per_grain']:.4f} ms/grain | "
+              f"labels kept {checked['labeled_per_scene']:.0f}/{density}")
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate dense synthetic rice scenes with YOLO labels.")
+    parser.add_argument("--num-images", type=int, default=NUM_IMAGES)
+    parser.add_argument("--grains-per-image", type=int, default=GRAINS_PER_IMAGE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--source-dir", default=SOURCE_DIR)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--max-occlusion", type=float, default=MAX_OCCLUSION,
+                        help="Max covered fraction of a labeled grain; more hidden grains are not labeled (<0 disables)")
+    parser.add_argument("--benchmark-density", action="store_true",
+                        help="Report scenes/sec at 50-1000 grains/scene with and without occlusion checks instead of generating")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Benchmark legacy vs in-place compositing at 50 and 500 grains/scene instead of generating")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    setup_dirs()
-    source_grains = load_source_images()
-    if not source_grains:
+    args = parse_args()
+    max_occlusion = args.max_occlusion if args.max_occlusion >= 0 else None
+    source_grains = load_source_images(args.source_dir)
+    atlas = build_atlas(source_grains)
+    if args.benchmark:
+        benchmark_compositing(atlas or synthetic_atlas(), seed=args.seed)
+        raise SystemExit(0)
+    if args.benchmark_density:
+        benchmark_density(atlas or synthetic_atlas(), seed=args.seed, max_occlusion=max_occlusion)
+        raise SystemExit(0)
+    setup_dirs(args.output_dir)
+    if not atlas:
         print("No source images found!")
     else:
-        print("Generating DENSE CLUSTERED synthetic data WITH SHADOWS...")
-        for i in tqdm(range(NUM_IMAGES)):
-            generate_scene(f"train_dense_{i}", source_grains)
+        print(f"Generating {args.num_images} DENSE CLUSTERED synthetic images WITH SHADOWS "
+              f"({args.workers} workers, seed {args.seed})...")
+        generate_dataset(atlas, args.num_images, args.workers, args.seed,
+                         args.output_dir, args.grains_per_image, max_occlusion)
         print("Done!")
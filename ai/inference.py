@@ -1,10 +1,26 @@
 import sys
 import json
+import base64
+import argparse
 import os
 import contextlib
+import logging
+import queue
+import threading
+import time
+import glob
+import io
+import re
+import struct
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
 import cv2
 import numpy as np
-from ultralytics import YOLO
+
+# ultralytics (and torch with it) is imported on first model load, not here:
+# it takes seconds, and images rejected by validate_image never need it
 
 # Path to the trained model
 # Support both local development and Docker environments
@@ -12,127 +28,922 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(script_dir)  # Go up one level from ai/ to project root
 MODEL_PATH = os.path.join(script_dir, 'runs/detect/rice_quality_v3/weights/best.pt')
 
-def preprocess_image(image_path):
+# Runtime backends and the weights each one loads (produced by export_model.py).
+# Select with --backend or the RICE_INFERENCE_BACKEND environment variable.
+WEIGHTS_DIR = os.path.dirname(MODEL_PATH)
+BACKENDS = {
+    'torch': MODEL_PATH,
+    'onnx': os.path.join(WEIGHTS_DIR, 'best.onnx'),
+    'onnx-int8': os.path.join(WEIGHTS_DIR, 'best_int8.onnx'),
+    'openvino': os.path.join(WEIGHTS_DIR, 'best_openvino_model'),
+    'openvino-int8': os.path.join(WEIGHTS_DIR, 'best_int8_openvino_model'),
+    # YOLOv8-Nano student distilled from the v3 model (distill.py)
+    'torch-nano': os.path.join(script_dir, 'runs/detect/rice_quality_nano/weights/best.pt'),
+}
+BACKEND = os.environ.get('RICE_INFERENCE_BACKEND', 'torch')
+
+# Loaded models, keyed by weights path; reloaded when the weights hash changes (see get_model)
+_models = {}
+
+# Detection confidence threshold
+CONF_THRESHOLD = 0.35
+
+# Images per model.predict call in batch mode
+DEFAULT_BATCH_SIZE = 8
+
+# Tiled mode: large images are split into overlapping TILE_SIZE tiles so small
+# grains are detected at full resolution instead of after downscaling to 640
+TILE_SIZE = int(os.environ.get('RICE_TILE_SIZE', 640))
+TILE_OVERLAP = float(os.environ.get('RICE_TILE_OVERLAP', 0.2))  # fraction of TILE_SIZE
+TILE_MERGE_IOU = 0.5  # IoU above which two tiles' boxes in their overlap band are one grain
+
+# Annotated images (opt-in) are written here, off the request's critical path
+# Save to project_root/runs/detect inside the container
+ANNOTATION_DIR = os.path.join(project_root, 'runs/detect/inference')
+_annotation_pool = ThreadPoolExecutor(max_workers=1)
+
+# Result cache (see ResultCache): in-memory LRU, plus an on-disk tier if RICE_CACHE_DIR is set
+CACHE_SIZE = int(os.environ.get('RICE_CACHE_SIZE', 256))
+CACHE_DIR = os.environ.get('RICE_CACHE_DIR')
+# Most result files kept in RICE_CACHE_DIR; the oldest are pruned past this
+CACHE_DISK_MAX = int(os.environ.get('RICE_CACHE_DISK_MAX', 10000))
+
+# Upload validation (see validate_image / quick_reject)
+BRIGHTNESS_THRESHOLD = 100  # mean gray level; grains on black are < 50, screenshots > 150
+BRIGHTNESS_MARGIN = 4.0     # a reduced-decode mean this far above the threshold is rejected outright
+BRIGHTNESS_ERROR = "Invalid image: Image is too bright. Please use an image with a dark background."
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # also the request limit of serve.py
+MIN_IMAGE_SIDE = 32
+MAX_IMAGE_PIXELS = 120_000_000
+HEADER_PROBE_BYTES = 64  # enough for the format signature and PNG/BMP dimensions
+
+# Stream mode (see analyze_stream): decoded frames buffered ahead of the model,
+# how many recent analyzed frames the rolling quality score covers, and the most
+# frames (analyzed, skipped or failed) held back waiting for a model batch
+STREAM_PREFETCH = 16
+STREAM_WINDOW = 100
+STREAM_MAX_PENDING = 64
+VIDEO_SUFFIXES = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# Per-stage timings (see StageTimer): RICE_TIMINGS=1 adds a "timings" key to every
+# result; RICE_METRICS_FILE appends one JSON line of timings per image to that file
+TIMINGS = os.environ.get('RICE_TIMINGS', '') not in ('', '0')
+METRICS_FILE = os.environ.get('RICE_METRICS_FILE')
+_metrics_lock = threading.Lock()
+
+class StageTimer:
+    """
+    Wall-clock time per pipeline stage, plus counters, for one image.
+    `with timer.stage("decode"): ...` accumulates into stages_ms; model_speed()
+    adds the preprocess/inference/postprocess split ultralytics measures itself.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.speed = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def model_speed(self, result):
+        for name, ms in (getattr(result, 'speed', None) or {}).items():
+            if ms is not None:
+                self.speed[name] = self.speed.get(name, 0.0) + ms
+
+    def as_dict(self):
+        timings = {
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "stages_ms": {name: round(sec * 1000, 3) for name, sec in self.stages.items()},
+        }
+        if self.speed:
+            timings["model_ms"] = {name: round(ms, 3) for name, ms in self.speed.items()}
+        if self.counters:
+            timings["counters"] = dict(self.counters)
+        return timings
+
+class _NullTimer:
+    """Disabled StageTimer: stage() hands back one shared no-op context manager."""
+    enabled = False
+    _noop = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._noop
+
+    def count(self, name, n=1):
+        pass
+
+    def model_speed(self, result):
+        pass
+
+NO_TIMER = _NullTimer()
+
+def new_timer(include):
+    """A StageTimer if timings are wanted in the result or the metrics file, else NO_TIMER."""
+    return StageTimer() if include or METRICS_FILE else NO_TIMER
+
+def emit_timings(output, timer, include):
+    """Attach timer's timings to output (if include) and append them to METRICS_FILE (if set)."""
+    if not timer.enabled:
+        return output
+    timings = timer.as_dict()
+    if METRICS_FILE:
+        line = json.dumps({"time": time.time(), "image": output.get("image"), "status": output.get("status"), **timings})
+        try:
+            with _metrics_lock, open(METRICS_FILE, 'a') as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Metrics write error: {e}", file=sys.stderr)
+    if include:
+        output["timings"] = timings
+    return output
+
+def decode_image(source):
+    """
+    Decode an image exactly once, keeping any alpha channel.
+    source can be a file path, raw encoded bytes (e.g. an upload piped on stdin)
+    or an already decoded ndarray, which is returned unchanged.
+    Returns None if the data cannot be decoded.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    return cv2.imread(source, cv2.IMREAD_UNCHANGED)
+
+def to_8bit(img):
+    """Scale 16-bit images down to 8 bits, the same way cv2.imread does by default."""
+    if img.dtype == np.uint16:
+        return (img >> 8).astype(np.uint8)
+    return img
+
+def preprocess_image(img):
     """
-    Preprocess image to handle transparent backgrounds.
+    Preprocess a decoded image to handle transparent backgrounds.
     Converts them to black to match training data.
+    Returns a 3-channel BGR uint8 array ready for the model.
     """
+    img = to_8bit(img)
+
+    # Handle different image formats
+    if img.ndim == 2 or (img.ndim == 3 and img.shape[2] == 1):
+        # Grayscale image, convert to BGR
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.ndim == 3 and img.shape[2] == 4:
+        # Image has alpha channel (transparency)
+        # Simple approach: replace transparent areas with black
+        rgb = img[:, :, :3]
+        alpha = img[:, :, 3:] / 255.0
+
+        # Blend: where alpha is 255 (opaque), use original; where 0 (transparent), black
+        return (rgb * alpha).astype(np.uint8)
+    if img.ndim == 3 and img.shape[2] == 3:
+        # Standard RGB/BGR image - use as is
+        return img
+    raise ValueError(f"Unsupported image format with shape {img.shape}")
+
+def mean_brightness(img):
+    """
+    Mean grayscale brightness of a decoded image.
+    Alpha is ignored, matching what validation saw when it read the file with cv2.imread.
+    """
+    img = to_8bit(img)
+    if img.ndim == 2:
+        return float(np.mean(img))
+    if img.shape[2] == 4:
+        img = img[:, :, :3]
+    elif img.shape[2] == 1:
+        return float(np.mean(img))
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return float(np.mean(gray))
+
+def read_header(source):
+    """(first HEADER_PROBE_BYTES, total size) of a path or bytes source without decoding it."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source[:HEADER_PROBE_BYTES])
+        return data, len(source)
+    with open(source, 'rb') as f:
+        return f.read(HEADER_PROBE_BYTES), os.fstat(f.fileno()).st_size
+
+def image_format(header):
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'BM'):
+        return 'bmp'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if header[:1] == b'P' and header[1:2] in b'123456':
+        return 'pnm'
+    return None
+
+def header_size(header, fmt):
+    """(width, height) from a PNG/BMP header, or None if it is not in the probed bytes."""
     try:
-        # Read image with alpha channel support
-        img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-        
-        if img is None:
-            return image_path
-        
-        # Handle different image formats
-        if len(img.shape) == 2:
-            # Grayscale image, convert to BGR
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-        elif len(img.shape) == 3 and img.shape[2] == 4:
-            # Image has alpha channel (transparency)
-            # Simple approach: replace transparent areas with black
-            rgb = img[:, :, :3]
-            alpha = img[:, :, 3]
-            
-            # Create black background
-            black_bg = np.zeros_like(rgb)
-            
-            # Blend: where alpha is 255 (opaque), use original; where 0 (transparent), use black
-            alpha_3ch = np.stack([alpha, alpha, alpha], axis=2) / 255.0
-            img = (rgb * alpha_3ch + black_bg * (1 - alpha_3ch)).astype(np.uint8)
-        elif len(img.shape) == 3 and img.shape[2] == 3:
-            # Standard RGB/BGR image - use as is
-            pass
-        else:
-            return image_path
-        
-        # Save preprocessed image
-        preprocessed_path = image_path.rsplit('.', 1)[0] + '_preprocessed.jpg'
-        cv2.imwrite(preprocessed_path, img)
-        
-        return preprocessed_path
-        
-    except Exception as e:
-        print(f"Preprocessing error: {e}", file=sys.stderr)
-        return image_path
+        if fmt == 'png':
+            return struct.unpack('>II', header[16:24])
+        if fmt == 'bmp':
+            w, h = struct.unpack('<ii', header[18:26])
+            return w, abs(h)
+    except struct.error:
+        pass
+    return None
+
+# SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC): the frame header with the image size
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_SOF_PATTERN = re.compile(rb'\xff[\xc0-\xc3\xc5-\xc7\xc9-\xcb\xcd-\xcf]')
 
+def jpeg_walk_size(f):
+    """
+    (width, height) from the SOF segment of a JPEG file object, seeking over
+    every segment before it by its length field, so EXIF/XMP/ICC blocks of any
+    size cost a seek rather than a read. None if the walk reaches the scan
+    data or a malformed marker first.
+    """
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        while code == 0xFF:  # fill bytes
+            byte = f.read(1)
+            if not byte:
+                return None
+            code = byte[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:  # markers without a length
+            continue
+        if code in (0xD9, 0xDA):  # end of image / start of scan
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if code in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            h, w = struct.unpack('>HH', frame[1:5])
+            return w, h
+        f.seek(struct.unpack('>H', length)[0] - 2, io.SEEK_CUR)
 
+def jpeg_scan_size(data):
+    """
+    Fallback for JPEGs whose segment chain is broken: the largest frame among
+    all SOF markers in the data (an EXIF thumbnail has its own, smaller one).
+    """
+    best = None
+    for match in JPEG_SOF_PATTERN.finditer(data):
+        frame = data[match.end() + 2:match.end() + 8]
+        if len(frame) < 6 or frame[0] not in (8, 12, 16) or frame[5] not in (1, 3, 4):
+            continue
+        h, w = struct.unpack('>HH', frame[1:5])
+        if w and h and (best is None or w * h > best[0] * best[1]):
+            best = (w, h)
+    return best
+
+def jpeg_size(source):
+    """(width, height) of a JPEG path or bytes source: segment walk, then a full header scan."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        size = jpeg_walk_size(io.BytesIO(source))
+        return size or jpeg_scan_size(bytes(source))
+    with open(source, 'rb') as f:
+        size = jpeg_walk_size(f)
+        if size is None:
+            f.seek(0)
+            size = jpeg_scan_size(f.read())
+    return size
+
+def reduced_gray_flag(size):
+    """
+    IMREAD_REDUCED_GRAYSCALE_* flag for a JPEG of this (width, height): 1/8 or
+    1/4 scale, keeping at least ~64k pixels, or None when the JPEG is too
+    small for a reduced decode to be much cheaper than the full one.
+    """
+    pixels = size[0] * size[1]
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4)):
+        if pixels / (factor * factor) >= 65536:
+            return flag
+    return None
+
+def reduced_gray(source, flag):
+    """
+    Grayscale JPEG decode at reduced scale. libjpeg scales during the DCT, so a
+    large JPEG never gets a full-size buffer; other formats would be decoded
+    at full size and then resized, which is why only JPEGs come here.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flag)
+    return cv2.imread(source, flag)
 
-def validate_image(image_path):
+def quick_reject(source):
+    """
+    Cheap checks on a path or bytes source before the full decode: file size,
+    format signature and header dimensions, then, for large JPEGs only, mean
+    brightness of a 1/4 or 1/8 scale grayscale decode. Returns an error
+    message, or None if the image should go on to the single full decode,
+    whose pixels the exact brightness check reuses. Only images clearly above
+    the brightness threshold (by BRIGHTNESS_MARGIN) are rejected here, so the
+    decision matches the full-resolution check.
+    """
+    try:
+        header, nbytes = read_header(source)
+    except OSError:
+        return "Could not read image file"
+    if nbytes == 0:
+        return "Could not read image file"
+    if nbytes > MAX_UPLOAD_BYTES:
+        return f"Invalid image: File is too large ({nbytes / 2**20:.1f} MB, max {MAX_UPLOAD_BYTES / 2**20:.0f} MB)."
+    fmt = image_format(header)
+    if fmt is None:
+        return "Invalid image: Unsupported image format. Please upload a JPEG, PNG, BMP, WebP or TIFF image."
+    size = jpeg_size(source) if fmt == 'jpeg' else header_size(header, fmt)
+    if size:
+        w, h = size
+        if min(w, h) < MIN_IMAGE_SIDE:
+            return f"Invalid image: Image is too small ({w}x{h})."
+        if w * h > MAX_IMAGE_PIXELS:
+            return f"Invalid image: Image is too large ({w}x{h})."
+
+    flag = reduced_gray_flag(size) if fmt == 'jpeg' and size else None
+    if flag is None:
+        return None
+    gray = reduced_gray(source, flag)
+    if gray is not None and float(np.mean(gray)) > BRIGHTNESS_THRESHOLD + BRIGHTNESS_MARGIN:
+        return BRIGHTNESS_ERROR
+    return None
+
+def validate_image(image):
+    """
+    Reject images that cannot be decoded or are too bright to be grains on a
+    black background. image may be a path, raw bytes or a decoded ndarray;
+    paths and bytes go through quick_reject first, so obviously bad uploads
+    are rejected without a full-resolution decode.
+    """
     try:
-        img = cv2.imread(image_path)
+        if not isinstance(image, np.ndarray):
+            error = quick_reject(image)
+            if error:
+                return False, error
+        img = decode_image(image)
         if img is None:
             return False, "Could not read image file"
 
         # Check average brightness
         # Rice grains on black background should result in low average brightness
         # Random screenshots usually have high brightness (white/light background)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        mean_brightness = np.mean(gray)
-        
         # Threshold: 100 out of 255. 
         # Screenshots are typically > 150-200. Dark background images are < 50.
-        if mean_brightness > 100:
-            return False, "Invalid image: Image is too bright. Please use an image with a dark background."
+        if mean_brightness(img) > BRIGHTNESS_THRESHOLD:
+            return False, BRIGHTNESS_ERROR
             
         return True, None
     except Exception as e:
         return False, f"Validation error: {str(e)}"
 
-def analyze_image(image_path):
+def load_image(source, timer=NO_TIMER):
+    """
+    Single-decode pipeline: decode once, validate, flatten alpha.
+    Returns (bgr_image, None) on success or (None, error_message).
+    """
     try:
-        # Validate image first
-        is_valid, validation_error = validate_image(image_path)
-        if not is_valid:
-            print(json.dumps({
-                "status": "error",
-                "error": validation_error
-            }))
-            return
+        if not isinstance(source, np.ndarray):
+            with timer.stage("probe"):
+                error = quick_reject(source)
+            if error:
+                return None, error
+        with timer.stage("decode"):
+            img = decode_image(source)
+        if img is None:
+            return None, "Could not read image file"
+    except Exception as e:
+        return None, f"Validation error: {str(e)}"
 
-        # Preprocess image to handle transparent/white backgrounds
-        processed_image_path = preprocess_image(image_path)
-        
-        # Load the model
-        # Redirect stdout/stderr to suppress "Results saved to..." messages
-        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
-            model = YOLO(MODEL_PATH)
-            
-            # Run inference on preprocessed image
-            # Using higher confidence threshold (0.35) for cleaner, more confident detections
-            # Save to project_root/runs/detect inside the container
-            save_dir = os.path.join(project_root, 'runs/detect')
-            results = model.predict(processed_image_path, conf=0.35, save=True, project=save_dir, name='inference', exist_ok=True, verbose=False)
-        
-        result = results[0]
-        
-        # Count classes
-        # Class 0: Full, Class 1: Broken
-        boxes = result.boxes
-        classes = boxes.cls.tolist()
-        
-        full_grains = classes.count(0.0)
-        broken_grains = classes.count(1.0)
-        total_grains = full_grains + broken_grains
-        
-        # Calculate quality (percentage of full grains)
-        if total_grains > 0:
-            quality_score = round((full_grains / total_grains) * 100, 2)
+    with timer.stage("validate"):
+        is_valid, validation_error = validate_image(img)
+    if not is_valid:
+        return None, validation_error
+
+    # Preprocess image to handle transparent/white backgrounds
+    with timer.stage("preprocess"):
+        return preprocess_image(img), None
+
+def source_name(source):
+    """Value reported in the "image" field: the path for files, None for in-memory input."""
+    return source if isinstance(source, (str, os.PathLike)) else None
+
+def backend_model_path(backend=None):
+    """Weights path for a runtime backend (defaults to the configured BACKEND)."""
+    backend = backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Choose from: {', '.join(BACKENDS)}")
+    return BACKENDS[backend]
+
+def quiet_ultralytics():
+    """
+    Keep ultralytics logging off stdout (the JSON channel) through its own
+    logger. Swapping sys.stdout/sys.stderr per call is process-global and not
+    safe with several inference threads (serve.py --models N).
+    """
+    os.environ.setdefault('YOLO_VERBOSE', 'False')  # read when ultralytics is first imported
+    from ultralytics.utils import LOGGER
+    LOGGER.setLevel(logging.ERROR)
+
+def load_model(model_path=None):
+    """
+    Load a new YOLO model instance (uncached; most callers want get_model).
+    Defaults to the weights of the configured backend; ultralytics picks the
+    runtime (PyTorch, ONNX Runtime, OpenVINO) from the weights format, and the
+    exported models keep the same class ids, so counting is unchanged.
+    """
+    model_path = model_path or backend_model_path()
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model not found: {model_path} (run export_model.py for non-torch backends)")
+    # Hashed before loading, so a file replaced mid-load is picked up by the next get_model
+    loaded_hash = weights_hash(model_path)
+    quiet_ultralytics()
+    from ultralytics import YOLO
+    model = YOLO(model_path, task='detect')
+    model.weights_hash = loaded_hash
+    return model
+
+def get_model(model_path=None):
+    """
+    Return a loaded YOLO model, loading it only on first use.
+    Long-lived callers (worker mode) reuse the same instance for every request;
+    it is reloaded when the weights file changes (same hash as cache_key).
+    """
+    model_path = model_path or backend_model_path()
+    model = _models.get(model_path)
+    if model is None or model.weights_hash != weights_hash(model_path):
+        model = load_model(model_path)
+        _models[model_path] = model
+    return model
+
+def model_weights_hash(model):
+    """Weights hash a model was loaded from (None for models not built by load_model)."""
+    return getattr(model, 'weights_hash', None)
+
+def run_model(model, sources):
+    """Run the detector on one or more sources; returns one ultralytics Result per source."""
+    # verbose=False plus quiet_ultralytics() keep per-image logging out of the JSON output
+    # Using higher confidence threshold (0.35) for cleaner, more confident detections
+    # Nothing is saved here; annotated images are opt-in (see annotate_async)
+    return model.predict(sources, conf=CONF_THRESHOLD, batch=len(sources), save=False, verbose=False)
+
+def tile_origins(length, tile_size, stride):
+    """Start offsets along one axis; the last tile is aligned to the image edge."""
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+def make_tiles(img, tile_size=None, overlap=None):
+    """Split img into overlapping tiles. Returns [(x0, y0, tile_view), ...]."""
+    tile_size = tile_size or TILE_SIZE
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    stride = max(1, int(tile_size * (1 - overlap)))
+    h, w = img.shape[:2]
+    return [(x0, y0, img[y0:y0 + tile_size, x0:x0 + tile_size])
+            for y0 in tile_origins(h, tile_size, stride)
+            for x0 in tile_origins(w, tile_size, stride)]
+
+def box_overlaps(a, b):
+    """Pairwise intersection areas, IoU and intersection over a's area for xyxy boxes a (n, 4) and b (m, 4)."""
+    iw = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    ih = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    inter = iw * ih
+    area_a = ((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]))[:, None]
+    area_b = ((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]))[None, :]
+    iou = inter / np.maximum(area_a + area_b - inter, 1e-6)
+    return iou, inter / np.maximum(area_a, 1e-6)
+
+def merge_tile_detections(tiles, iou_threshold=TILE_MERGE_IOU, cut_overlap=0.5):
+    """
+    Merge per-tile detections into one set for the whole image.
+
+    tiles: [(x0, y0, x1, y1, data (n, 6) xyxy/conf/cls in image coordinates,
+    cut (n,) bool: box touches an interior tile edge), ...].
+    Only detections from two different tiles are ever compared, so touching
+    grains inside one tile (already separated by the model's NMS) are kept:
+      - a whole grain seen by both tiles of an overlap band appears twice:
+        pairs whose centres both lie in that band and whose IoU is at least
+        iou_threshold keep only the higher-confidence box
+      - a cut box is dropped when the other tile has an uncut box covering
+        at least cut_overlap of it (that tile saw the grain whole)
+      - cut boxes with no such counterpart (grains larger than the overlap)
+        are kept, and cut pieces of the same grain from different tiles are
+        joined into their union box
+    Returns the merged (k, 6) array.
+    """
+    keep = [np.ones(len(data), dtype=bool) for *_, data, _ in tiles]
+    for a in range(len(tiles)):
+        ax0, ay0, ax1, ay1, da, cut_a = tiles[a]
+        for b in range(a + 1, len(tiles)):
+            bx0, by0, bx1, by1, db, cut_b = tiles[b]
+            band = (max(ax0, bx0), max(ay0, by0), min(ax1, bx1), min(ay1, by1))
+            if band[0] >= band[2] or band[1] >= band[3] or not len(da) or not len(db):
+                continue
+
+            def in_band(data):
+                cx, cy = (data[:, 0] + data[:, 2]) / 2, (data[:, 1] + data[:, 3]) / 2
+                return (cx >= band[0]) & (cx < band[2]) & (cy >= band[1]) & (cy < band[3])
+
+            # Whole grains seen by both tiles
+            ia = np.flatnonzero(~cut_a & in_band(da))
+            ib = np.flatnonzero(~cut_b & in_band(db))
+            if len(ia) and len(ib):
+                iou, _ = box_overlaps(da[ia, :4], db[ib, :4])
+                for i, j in sorted(zip(*np.nonzero(iou >= iou_threshold)), key=lambda p: -iou[p]):
+                    if keep[a][ia[i]] and keep[b][ib[j]]:
+                        if da[ia[i], 4] >= db[ib[j], 4]:
+                            keep[b][ib[j]] = False
+                        else:
+                            keep[a][ia[i]] = False
+
+            # Cut boxes the other tile saw whole
+            for cut, data, mine, other, other_cut, other_keep in ((cut_a, da, keep[a], db, cut_b, keep[b]),
+                                                                   (cut_b, db, keep[b], da, cut_a, keep[a])):
+                ic, iw = np.flatnonzero(cut & mine), np.flatnonzero(~other_cut & other_keep)
+                if len(ic) and len(iw):
+                    _, covered = box_overlaps(data[ic, :4], other[iw, :4])
+                    mine[ic[covered.max(axis=1) >= cut_overlap]] = False
+
+    # Remaining cut pieces: join pieces of one grain from different tiles
+    pieces = [(t, i) for t, (*_, cut) in enumerate(tiles) for i in np.flatnonzero(cut & keep[t])]
+    merged = [data[keep[t] & ~cut] for t, (*_, data, cut) in enumerate(tiles)]
+    groups = []  # [tile ids, box]
+    for t, i in pieces:
+        box = tiles[t][4][i].copy()
+        for group in groups:
+            if t in group[0]:
+                continue
+            _, covered = box_overlaps(box[None, :4], group[1][None, :4])
+            _, covered_back = box_overlaps(group[1][None, :4], box[None, :4])
+            if max(covered[0, 0], covered_back[0, 0]) >= cut_overlap:
+                union = group[1]
+                union[:2] = np.minimum(union[:2], box[:2])
+                union[2:4] = np.maximum(union[2:4], box[2:4])
+                if box[4] > union[4]:
+                    union[4:] = box[4:]
+                group[0].add(t)
+                break
         else:
-            quality_score = 0.0
-            
-        # Get path to saved annotated image (optional, for debugging)
-        # It usually saves to runs/detect/inference/<filename>
-        
-        output = {
-            "status": "success",
-            "image": image_path,
-            "total_grains": total_grains,
-            "good_grains": full_grains,
-            "broken_grains": broken_grains,
-            "quality_score": quality_score,
-            "details": "Real YOLOv8 Inference"
-        }
+            groups.append([{t}, box])
+    merged.append(np.array([box for _, box in groups], dtype=np.float32).reshape(-1, 6))
+    return np.concatenate(merged) if merged else np.zeros((0, 6), dtype=np.float32)
+
+def run_tiled(model, img, tile_size=None, overlap=None):
+    """
+    Tiled inference for large images: batch-infer overlapping tiles at their
+    native resolution, shift boxes back to image coordinates and merge the
+    tiles' detections (see merge_tile_detections). Returns a single
+    ultralytics Result so it can be summarized and annotated like a normal
+    prediction.
+    """
+    import torch
+    from ultralytics.engine.results import Results
+
+    tile_size = tile_size or TILE_SIZE
+    h, w = img.shape[:2]
+    tiles = make_tiles(img, tile_size, overlap)
+    edge = 2  # px; boxes this close to an interior tile edge are treated as cut
+
+    detections = []
+    for start in range(0, len(tiles), DEFAULT_BATCH_SIZE):
+        chunk = tiles[start:start + DEFAULT_BATCH_SIZE]
+        results = run_model(model, [tile for _, _, tile in chunk])
+        for (x0, y0, tile), result in zip(chunk, results):
+            data = result.boxes.data.cpu().numpy().reshape(-1, 6)  # x1, y1, x2, y2, conf, cls
+            th, tw = tile.shape[:2]
+            cut = np.zeros(len(data), dtype=bool)
+            if x0 > 0:
+                cut |= data[:, 0] <= edge
+            if y0 > 0:
+                cut |= data[:, 1] <= edge
+            if x0 + tw < w:
+                cut |= data[:, 2] >= tw - edge
+            if y0 + th < h:
+                cut |= data[:, 3] >= th - edge
+            data = data.copy()
+            data[:, [0, 2]] += x0
+            data[:, [1, 3]] += y0
+            detections.append((x0, y0, x0 + tw, y0 + th, data, cut))
+
+    data = merge_tile_detections(detections)
+    return Results(img, path='', names=model.names, boxes=torch.from_numpy(data))
+
+def predict_images(model, images, tile=False):
+    """One Result per image; tiled images are handled one at a time (their tiles are batched)."""
+    if tile:
+        return [run_tiled(model, img) if max(img.shape[:2]) > TILE_SIZE else run_model(model, [img])[0]
+                for img in images]
+    return run_model(model, images)
+
+def annotated_path(image_name):
+    """Where the annotated copy of image_name is written (runs/detect/inference/<stem>.jpg)."""
+    if image_name:
+        stem = os.path.splitext(os.path.basename(image_name))[0]
+    else:
+        stem = f"image_{time.time_ns()}"
+    return os.path.join(ANNOTATION_DIR, stem + '.jpg')
+
+def write_annotation(result, path):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, result.plot())
+    except Exception as e:
+        print(f"Annotation error: {e}", file=sys.stderr)
+
+def annotate_async(result, image_name):
+    """
+    Render and save the annotated image on a background thread so the JSON
+    result is not held up by drawing and JPEG encoding. Returns the output path.
+    """
+    path = annotated_path(image_name)
+    _annotation_pool.submit(write_annotation, result, path)
+    return path
+
+def summarize(result, image_path):
+    """Turn one ultralytics Result into the JSON-serializable output dict."""
+    # Count classes
+    # Class 0: Full, Class 1: Broken
+    boxes = result.boxes
+    classes = boxes.cls.tolist()
+    
+    full_grains = classes.count(0.0)
+    broken_grains = classes.count(1.0)
+    total_grains = full_grains + broken_grains
+    
+    # Calculate quality (percentage of full grains)
+    if total_grains > 0:
+        quality_score = round((full_grains / total_grains) * 100, 2)
+    else:
+        quality_score = 0.0
+
+    return {
+        "status": "success",
+        "image": image_path,
+        "total_grains": total_grains,
+        "good_grains": full_grains,
+        "broken_grains": broken_grains,
+        "quality_score": quality_score,
+        "details": "Real YOLOv8 Inference"
+    }
+
+def weights_hash(model_path):
+    """
+    Content hash of a weights file (or exported model directory).
+    Memoized on path + size + mtime, so replacing the weights changes the hash
+    without re-reading the file on every request.
+    """
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model not found: {model_path} (run export_model.py for non-torch backends)")
+    files = [model_path]
+    if os.path.isdir(model_path):
+        files = sorted(os.path.join(root, f) for root, _, names in os.walk(model_path) for f in names)
+    stamp = tuple((f, os.path.getsize(f), os.path.getmtime(f)) for f in files)
+    cached = _weights_hashes.get(model_path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    for f in files:
+        with open(f, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(chunk)
+    value = digest.hexdigest()[:16]
+    _weights_hashes[model_path] = (stamp, value)
+    return value
+
+_weights_hashes = {}
+
+def cache_key(img, tile=False, weights=None):
+    """
+    Key for a preprocessed image: hash of the decoded pixels plus everything
+    that changes the answer (weights hash, conf threshold, tiling settings).
+    weights defaults to the hash of the configured backend's weights file.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(img.shape).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    weights = weights or weights_hash(backend_model_path())
+    settings = f"{weights}|{CONF_THRESHOLD}"
+    if tile:
+        settings += f"|tile:{TILE_SIZE}:{TILE_OVERLAP}"
+    digest.update(settings.encode())
+    return digest.hexdigest()
+
+def result_key(key, key_weights, img, tile, model):
+    """
+    Key to store a fresh result under. Lookup keys use the hash of the weights
+    on disk, but the model may have been loaded from older weights (a pool
+    model, or a file replaced mid-request); re-key with the model's own hash so
+    a result is never cached under weights that did not produce it.
+    """
+    loaded = model_weights_hash(model)
+    if not key or loaded == key_weights:
+        return key
+    return cache_key(img, tile, loaded) if loaded else None
+
+class ResultCache:
+    """
+    Cache of analysis results keyed by cache_key().
+
+    A bounded in-memory LRU, optionally backed by a directory of JSON files
+    that survives restarts. Keys include the weights hash, so entries for old
+    weights simply stop matching when MODEL_PATH changes; the directory is
+    bounded to max_disk_entries files, pruning the least recently used
+    (by mtime, refreshed on disk hits). Thread-safe.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, disk_dir=CACHE_DIR, max_disk_entries=CACHE_DISK_MAX):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_entries = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_entries = len(self._disk_files())
+            self._prune_disk()
+
+    def _disk_files(self):
+        return [f for f in os.listdir(self.disk_dir) if f.endswith('.json')]
+
+    def _prune_disk(self):
+        """Delete the oldest result files once the directory exceeds max_disk_entries."""
+        if not self.max_disk_entries or self._disk_entries <= self.max_disk_entries:
+            return
+        files = []
+        for name in self._disk_files():
+            path = os.path.join(self.disk_dir, name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        files.sort()
+        # Prune to 90% so a full cache doesn't rescan the directory on every write
+        excess = len(files) - int(self.max_disk_entries * 0.9)
+        for _, path in files[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_entries = len(files) - max(excess, 0)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.json')
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(value)
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key)) as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                try:
+                    os.utime(self._disk_path(key))
+                except OSError:
+                    pass
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                self._remember(key, value)
+                return dict(value)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = path + f'.{os.getpid()}.tmp'
+            try:
+                is_new = not os.path.exists(path)
+                with open(tmp_path, 'w') as f:
+                    json.dump(value, f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Cache write error: {e}", file=sys.stderr)
+                return
+            if is_new:
+                with self._lock:
+                    self._disk_entries += 1
+                self._prune_disk()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = dict(value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk_dir": self.disk_dir,
+                "disk_entries": self._disk_entries,
+                "max_disk_entries": self.max_disk_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+_cache = ResultCache() if CACHE_SIZE > 0 else None
+
+def cached_output(key, image_name):
+    """Cached result for key with the per-request "image" field filled in, or None."""
+    if _cache is None:
+        return None
+    output = _cache.get(key)
+    if output is not None:
+        output["image"] = image_name
+    return output
+
+def store_output(key, output):
+    if _cache is not None and output.get("status") == "success":
+        _cache.put(key, {k: v for k, v in output.items() if k not in ("image", "annotated_image", "timings")})
+
+def analyze(source, image_name=None, annotate=False, tile=False, use_cache=True, timings=None, model=None):
+    """
+    Run the full decode -> validate -> preprocess -> predict pipeline and return the result dict.
+    source may be a path, raw image bytes or a decoded ndarray.
+    With annotate=True an annotated image is written in the background and its
+    path is returned under "annotated_image".
+    With tile=True images larger than TILE_SIZE use tiled inference (see run_tiled).
+    Results are cached by image content (see ResultCache); annotate=True always
+    runs the model, since drawing needs the detections.
+    With timings=True (default: TIMINGS) per-stage times are returned under "timings".
+    model overrides the shared get_model() instance (serve.py keeps a pool of them).
+    """
+    include = TIMINGS if timings is None else timings
+    timer = new_timer(include)
+    try:
+        img, error = load_image(source, timer)
+        if error:
+            return emit_timings({
+                "status": "error",
+                "error": error
+            }, timer, include)
+
+        image_name = image_name or source_name(source)
+        with timer.stage("cache"):
+            key = key_weights = None
+            if use_cache and _cache is not None:
+                key_weights = weights_hash(backend_model_path())
+                key = cache_key(img, tile, key_weights)
+            output = cached_output(key, image_name) if key and not annotate else None
+        if output is not None:
+            timer.count("cache_hit")
+            return emit_timings(output, timer, include)
+
+        with timer.stage("model_load"):
+            model = model or get_model()
+        with timer.stage("predict"):
+            results = predict_images(model, [img], tile=tile)
+        timer.model_speed(results[0])
+        with timer.stage("summarize"):
+            output = summarize(results[0], image_name)
+            key = result_key(key, key_weights, img, tile, model)
+            if key:
+                store_output(key, output)
+        timer.count("boxes", output["total_grains"])
+        if annotate:
+            output["annotated_image"] = annotate_async(results[0], image_name)
         
     except Exception as e:
         output = {
@@ -140,13 +951,555 @@ def analyze_image(image_path):
             "error": str(e)
         }
     
+    return emit_timings(output, timer, include)
+
+def analyze_batch(sources, batch_size=DEFAULT_BATCH_SIZE, annotate=False, tile=False, use_cache=True, timings=None):
+    """
+    Analyze many images, sending them through the model batch_size at a time.
+    sources may mix paths, raw bytes and ndarrays.
+    Returns one result dict per input, in input order (same shape as analyze()).
+    Images that fail validation get their error dict and are left out of the batch,
+    as are cache hits.
+    With timings, each image's "predict" stage is the wall time of its whole batch.
+    """
+    include = TIMINGS if timings is None else timings
+    use_cache = use_cache and _cache is not None
+    outputs = [None] * len(sources)
+    keys = [None] * len(sources)
+    key_weights = [None] * len(sources)
+    timers = [new_timer(include) for _ in sources]
+    pending = []  # (index, preprocessed image)
+    for i, source in enumerate(sources):
+        try:
+            img, error = load_image(source, timers[i])
+            if error:
+                outputs[i] = {"status": "error", "error": error}
+                continue
+            if use_cache:
+                with timers[i].stage("cache"):
+                    key_weights[i] = weights_hash(backend_model_path())
+                    keys[i] = cache_key(img, tile, key_weights[i])
+                    if not annotate:
+                        outputs[i] = cached_output(keys[i], source_name(source))
+                if outputs[i] is not None:
+                    timers[i].count("cache_hit")
+                    continue
+            pending.append((i, img))
+        except Exception as e:
+            outputs[i] = {"status": "error", "error": str(e)}
+
+    model, model_load = None, 0.0
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        try:
+            # Loaded inside the try so a missing model fails each image, not the whole call
+            if model is None:
+                model_start = time.perf_counter()
+                model = get_model()
+                model_load = time.perf_counter() - model_start
+            predict_start = time.perf_counter()
+            results = predict_images(model, [img for _, img in chunk], tile=tile)
+            predict = time.perf_counter() - predict_start
+            for (i, img), result in zip(chunk, results):
+                timer = timers[i]
+                if timer.enabled:
+                    timer.stages["model_load"] = model_load
+                    timer.stages["predict"] = predict
+                    timer.count("batch_size", len(chunk))
+                    timer.model_speed(result)
+                with timer.stage("summarize"):
+                    outputs[i] = summarize(result, source_name(sources[i]))
+                    key = result_key(keys[i], key_weights[i], img, tile, model)
+                    if key:
+                        store_output(key, outputs[i])
+                timer.count("boxes", outputs[i]["total_grains"])
+                if annotate:
+                    outputs[i]["annotated_image"] = annotate_async(result, source_name(sources[i]))
+        except Exception as e:
+            for i, _ in chunk:
+                outputs[i] = {"status": "error", "error": str(e)}
+
+    return [emit_timings(output, timer, include) for output, timer in zip(outputs, timers)]
+
+class MicroBatcher:
+    """
+    Collects concurrent analyze requests into batches.
+
+    submit() returns a concurrent.futures.Future right away. A background thread
+    waits up to max_wait_ms after the first queued request for more requests to
+    arrive (or until max_batch are queued), then runs them as one batch per
+    distinct set of options. Used by the --worker loop.
+    """
+
+    def __init__(self, max_batch=DEFAULT_BATCH_SIZE, max_wait_ms=10):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, source, annotate=False, tile=False, timings=None):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self._queue.put((source, (annotate, tile, timings), future))
+        return future
+
+    def analyze(self, source, **options):
+        """Blocking convenience wrapper around submit()."""
+        return self.submit(source, **options).result()
+
+    def close(self):
+        """Finish the queued requests and stop the batching thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._flush(batch)
+                    return
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        groups = {}
+        for source, options, future in batch:
+            groups.setdefault(options, []).append((source, future))
+        for (annotate, tile, timings), group in groups.items():
+            # Any failure goes to the callers' futures; the batching thread must keep running
+            try:
+                outputs = analyze_batch([source for source, _ in group], batch_size=len(group),
+                                        annotate=annotate, tile=tile, timings=timings)
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(group, outputs):
+                future.set_result(output)
+
+def stream_frames(source):
+    """
+    Yield (name, frame_index, image) from a video file, a camera index ("0"),
+    a directory of images or a glob pattern. Images are decoded here, so this
+    runs on the prefetch thread.
+    """
+    if source.isdigit() or source.lower().endswith(VIDEO_SUFFIXES):
+        capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        if not capture.isOpened():
+            raise ValueError(f"Could not open video stream: {source}")
+        try:
+            index = 0
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield f"{source}:{index}", index, frame
+                index += 1
+        finally:
+            capture.release()
+
+    if os.path.isdir(source):
+        paths = sorted(os.path.join(source, f) for f in os.listdir(source) if f.lower().endswith(IMAGE_SUFFIXES))
+    else:
+        paths = sorted(glob.glob(source))
+    for index, path in enumerate(paths):
+        yield path, index, decode_image(path)
+
+def prefetch(iterator, maxsize=STREAM_PREFETCH):
+    """
+    Run iterator on a background thread, keeping at most maxsize items ready.
+    The bounded queue is what keeps memory flat on long streams: the decoder
+    blocks when the model falls behind. Exceptions are re-raised in the caller.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def frame_signature(img):
+    """Tiny grayscale thumbnail used to spot near-identical consecutive frames."""
+    gray = img if img.ndim == 2 else cv2.cvtColor(img[:, :, :3], cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+class RollingQuality:
+    """Quality score over the last `window` analyzed frames, plus running totals (constant memory)."""
+
+    def __init__(self, window=STREAM_WINDOW):
+        self.frames = deque(maxlen=window)
+        self.good = 0
+        self.broken = 0
+        self.total_good = 0
+        self.total_broken = 0
+
+    def add(self, good, broken):
+        if len(self.frames) == self.frames.maxlen:
+            old_good, old_broken = self.frames[0]
+            self.good -= old_good
+            self.broken -= old_broken
+        self.frames.append((good, broken))
+        self.good += good
+        self.broken += broken
+        self.total_good += good
+        self.total_broken += broken
+
+    @staticmethod
+    def score(good, broken):
+        return round(good / (good + broken) * 100, 2) if good + broken else 0.0
+
+    def rolling(self):
+        return {
+            "frames": len(self.frames),
+            "good_grains": self.good,
+            "broken_grains": self.broken,
+            "quality_score": self.score(self.good, self.broken),
+        }
+
+def analyze_stream(source, batch_size=DEFAULT_BATCH_SIZE, skip_threshold=0.0, window=STREAM_WINDOW, tile=False):
+    """
+    Analyze a video or image sequence frame by frame; yields one result dict per frame.
+
+    Frames are decoded on a background thread into a bounded queue and sent
+    to the model batch_size at a time. With skip_threshold > 0, a frame whose
+    32x32 grayscale thumbnail differs from the last analyzed frame by less than
+    that mean absolute difference (0-255) is not run through the model: it is
+    reported as "skipped" with the counts of the frame it duplicates.
+    Every successful result carries a "rolling" aggregate over the last
+    `window` analyzed frames. Skipped and unreadable frames are yielded as
+    soon as no earlier frame is waiting for the model. If the model fails to
+    load or predict, the frames of that batch are yielded as errors and the
+    stream goes on. After the last frame a summary dict with
+    "status": "complete" is yielded.
+    """
+    rolling = RollingQuality(window)
+    stats = {"frames": 0, "analyzed": 0, "skipped": 0, "errors": 0}
+    pending = []  # (name, index, preprocessed image or None if skipped, error)
+    last_signature = None
+    last_output = None
+    model = None
+
+    def flush():
+        nonlocal model, last_output
+        images = [img for _, _, img, _ in pending if img is not None]
+        results, failure = iter([]), None
+        if images:
+            try:
+                model = model or get_model()
+                results = iter(predict_images(model, images, tile=tile))
+            except Exception as e:
+                failure = str(e)
+        for name, index, img, error in pending:
+            if img is not None and failure:
+                error = failure
+                # Later near-duplicates of this frame have no counts to copy
+                last_output = None
+            elif img is None and not error and last_output is None:
+                error = "Duplicate of a frame that could not be analyzed"
+            if error:
+                stats["errors"] += 1
+                output = {"status": "error", "image": name, "frame": index, "error": error}
+            elif img is None:
+                stats["skipped"] += 1
+                output = {**last_output, "image": name, "frame": index, "status": "skipped",
+                          "duplicate_of": last_output["image"]}
+            else:
+                stats["analyzed"] += 1
+                output = summarize(next(results), name)
+                output["frame"] = index
+                rolling.add(output["good_grains"], output["broken_grains"])
+                last_output = {k: v for k, v in output.items() if k != "rolling"}
+            if output["status"] != "error":
+                output["rolling"] = rolling.rolling()
+            yield output
+        pending.clear()
+
+    for name, index, frame in prefetch(stream_frames(source)):
+        stats["frames"] += 1
+        if frame is None:
+            pending.append((name, index, None, "Could not read image file"))
+        else:
+            img, error = load_image(frame)
+            if error:
+                pending.append((name, index, None, error))
+            else:
+                signature = frame_signature(img) if skip_threshold > 0 else None
+                if (signature is not None and last_signature is not None
+                        and float(np.mean(np.abs(signature - last_signature))) < skip_threshold):
+                    pending.append((name, index, None, None))
+                else:
+                    last_signature = signature
+                    pending.append((name, index, img, None))
+        waiting = sum(1 for p in pending if p[2] is not None)
+        if not waiting or waiting >= batch_size or len(pending) >= STREAM_MAX_PENDING:
+            yield from flush()
+    yield from flush()
+
+    yield {
+        "status": "complete",
+        "source": source,
+        **stats,
+        "good_grains": rolling.total_good,
+        "broken_grains": rolling.total_broken,
+        "quality_score": RollingQuality.score(rolling.total_good, rolling.total_broken),
+    }
+
+def measure_throughput(image_paths, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Compare images/sec of the one-at-a-time path (analyze) against analyze_batch.
+    The model is loaded and warmed up before timing so load cost is excluded.
+    """
+    img, _ = load_image(image_paths[0])
+    if img is not None:
+        run_model(get_model(), [img])
+
+    start = time.perf_counter()
+    for image_path in image_paths:
+        analyze(image_path, use_cache=False)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    analyze_batch(image_paths, batch_size=batch_size, use_cache=False)
+    batched = time.perf_counter() - start
+
+    return {
+        "images": len(image_paths),
+        "batch_size": batch_size,
+        "sequential_images_per_sec": round(len(image_paths) / sequential, 2),
+        "batched_images_per_sec": round(len(image_paths) / batched, 2),
+        "speedup": round(sequential / batched, 2)
+    }
+
+def analyze_image(image_path, annotate=False, tile=False):
     # Print JSON to stdout
-    print(json.dumps(output))
+    print(json.dumps(analyze(image_path, annotate=annotate, tile=tile)))
+
+def handle_request(line):
+    """
+    Handle one worker request line.
+    Accepts either a bare image path or a JSON object {"id": ..., "image": ...}
+    ({"id": ..., "images": [...]} runs the list as one batch and
+    {"id": ..., "data": <base64 image bytes>} analyzes an in-memory upload).
+    Add "annotate": true to also get an annotated image, "tile": true for tiled inference,
+    "timings": true for per-stage timings.
+    {"cmd": "stats"} returns the result cache hit/miss counters.
+    The "id" is echoed back so callers can match responses to requests.
+    """
+    line = line.strip()
+    if not line.startswith(('{', '[')):
+        return analyze(line)
+
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return {"status": "error", "error": f"Invalid request: {e}"}
+
+    if not isinstance(request, dict):
+        return {"status": "error", "error": "Invalid request: request must be a JSON object"}
+    annotate = bool(request.get('annotate', False))
+    tile = bool(request.get('tile', False))
+    timings = request.get('timings')
+    if request.get('cmd') == 'stats':
+        output = {"status": "success", "cache": _cache.stats() if _cache else None}
+    elif 'data' in request:
+        # Base64-encoded image bytes, decoded in memory without a temp file
+        try:
+            data = base64.b64decode(request['data'], validate=True)
+        except (TypeError, ValueError) as e:
+            data = None
+            output = {"status": "error", "error": f"Invalid request: \"data\" is not base64 ({e})"}
+        if data is not None:
+            output = analyze(data, image_name=request.get('image'), annotate=annotate, tile=tile, timings=timings)
+    elif 'images' in request:
+        if not isinstance(request['images'], list) or not all(isinstance(p, str) for p in request['images']):
+            output = {"status": "error", "error": "Invalid request: \"images\" must be a list of paths"}
+        else:
+            output = {"status": "success", "results": analyze_batch(request['images'], annotate=annotate, tile=tile, timings=timings)}
+    elif 'image' not in request:
+        output = {"status": "error", "error": "No image path provided"}
+    elif not isinstance(request['image'], str):
+        output = {"status": "error", "error": "Invalid request: \"image\" must be a path"}
+    else:
+        output = analyze(request['image'], annotate=annotate, tile=tile, timings=timings)
+    if 'id' in request:
+        output = {"id": request['id'], **output}
+    return output
+
+def request_id_of(line):
+    """The "id" of a JSON request line, if it has one."""
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return None
+    return request.get('id') if isinstance(request, dict) else None
+
+def batchable_request(line):
+    """
+    The parsed request if it is a single image path with an "id", else None.
+    Only those go through the MicroBatcher: their answers may come back out of
+    order, which callers matching by id can handle.
+    """
+    if not line.lstrip().startswith('{'):
+        return None
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or 'id' not in request or not isinstance(request.get('image'), str):
+        return None
+    if any(key in request for key in ('cmd', 'data', 'images')):
+        return None
+    return request
+
+def run_worker(stdin=sys.stdin, stdout=sys.stdout, batch_size=DEFAULT_BATCH_SIZE, max_wait_ms=10):
+    """
+    Long-lived worker: load the model once, then answer one JSON line per request line.
+    Single-image requests with an "id" that arrive together (pipelined by the
+    caller) are run as one batch by a MicroBatcher and answered as they finish;
+    anything else is answered in order once the batches before it are done.
+    Exits cleanly when stdin is closed.
+    """
+    try:
+        get_model()
+        ready = {"status": "ready", "model": backend_model_path()}
+    except Exception as e:
+        ready = {"status": "error", "error": f"Model load failed: {e}"}
+    stdout.write(json.dumps(ready) + "\n")
+    stdout.flush()
+
+    lock = threading.Lock()  # guards stdout and pending; replies come from the batching thread
+    pending = set()
+    batcher = MicroBatcher(max_batch=batch_size, max_wait_ms=max_wait_ms)
+
+    def write(output):
+        stdout.write(json.dumps(output) + "\n")
+        stdout.flush()
+
+    def reply(request_id, future):
+        try:
+            output = future.result()
+        except Exception as e:
+            output = {"status": "error", "error": f"Request failed: {e}"}
+        with lock:
+            write({"id": request_id, **output})
+            pending.discard(future)
+
+    try:
+        for line in stdin:
+            if not line.strip():
+                continue
+            request = batchable_request(line)
+            if request is not None:
+                future = batcher.submit(request['image'], annotate=bool(request.get('annotate', False)),
+                                        tile=bool(request.get('tile', False)), timings=request.get('timings'))
+                with lock:
+                    pending.add(future)
+                future.add_done_callback(partial(reply, request['id']))
+                continue
+
+            # The model is not shared between threads: let queued batches finish first
+            with lock:
+                outstanding = list(pending)
+            wait(outstanding)
+            try:
+                output = handle_request(line)
+            except Exception as e:
+                # One bad request must not take down the worker and every request queued behind it
+                output = {"status": "error", "error": f"Request failed: {e}"}
+                request_id = request_id_of(line)
+                if request_id is not None:
+                    output = {"id": request_id, **output}
+            with lock:
+                write(output)
+    finally:
+        batcher.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Count Full/Broken rice grains in an image.")
+    parser.add_argument('images', nargs='*', help="Image path(s); '-' reads image bytes from stdin")
+    parser.add_argument('--worker', action='store_true', help="Serve JSON-line requests on stdin/stdout")
+    parser.add_argument('--batch', action='store_true', help="Analyze all images as batches, one JSON line each")
+    parser.add_argument('--throughput', action='store_true', help="Compare one-at-a-time vs batched images/sec")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--annotate', action='store_true', help="Also write an annotated image (in the background)")
+    parser.add_argument('--tile', action='store_true', help="Tiled inference for images larger than --tile-size")
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
+    parser.add_argument('--tile-overlap', type=float, default=TILE_OVERLAP, help="Tile overlap as a fraction of tile size")
+    parser.add_argument('--no-cache', action='store_true', help="Disable the result cache")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help="On-disk result cache directory (default: $RICE_CACHE_DIR)")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default=BACKEND, help="Runtime backend (default: $RICE_INFERENCE_BACKEND or torch)")
+    parser.add_argument('--stream', metavar='SOURCE', help="Analyze a video file, camera index, image directory or glob; one JSON line per frame")
+    parser.add_argument('--skip-similar', type=float, default=0.0, metavar='DIFF', help="Stream mode: skip frames whose thumbnail differs from the last analyzed one by less than DIFF (0-255)")
+    parser.add_argument('--window', type=int, default=STREAM_WINDOW, help="Stream mode: frames in the rolling quality score")
+    parser.add_argument('--timings', action='store_true', default=TIMINGS, help="Add per-stage timings to each result (default: $RICE_TIMINGS)")
+    parser.add_argument('--metrics-file', default=METRICS_FILE, help="Append per-image timings as JSON lines here (default: $RICE_METRICS_FILE)")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    args = parse_args()
+    BACKEND = args.backend
+    TILE_SIZE, TILE_OVERLAP = args.tile_size, args.tile_overlap
+    TIMINGS, METRICS_FILE = args.timings, args.metrics_file
+    if args.no_cache:
+        _cache = None
+    elif args.cache_dir != CACHE_DIR:
+        _cache = ResultCache(disk_dir=args.cache_dir)
+
+    if args.worker:
+        run_worker(batch_size=args.batch_size)
+        sys.exit(0)
+
+    if args.stream:
+        for output in analyze_stream(args.stream, batch_size=args.batch_size, skip_threshold=args.skip_similar,
+                                     window=args.window, tile=args.tile):
+            print(json.dumps(output), flush=True)
+        sys.exit(0)
+
+    if not args.images:
         print(json.dumps({"error": "No image path provided"}))
         sys.exit(1)
-        
-    image_path = sys.argv[1]
-    analyze_image(image_path)
+
+    if args.throughput:
+        print(json.dumps(measure_throughput(args.images, batch_size=args.batch_size)))
+    elif args.batch:
+        for output in analyze_batch(args.images, batch_size=args.batch_size, annotate=args.annotate, tile=args.tile):
+            print(json.dumps(output))
+    elif args.images[0] == '-':
+        # Raw image bytes piped on stdin, e.g. an upload streamed without a temp file
+        print(json.dumps(analyze(sys.stdin.buffer.read(), annotate=args.annotate, tile=args.tile)))
+    else:
+        analyze_image(args.images[0], annotate=args.annotate, tile=args.tile)
@@ -0,0 +1,314 @@
+"""
+Multi-process inference pool for many-core hosts.
+
+One torch process does not scale linearly with intra-op threads on small
+640px images, and one process per request oversubscribes the cores. This
+pool starts a fixed number of worker processes, each with its own model,
+`threads` intra-op threads and (optionally) its own set of pinned cores,
+and sends every request to the worker with the fewest outstanding requests.
+
+  pool = InferencePool(workers=4, threads=2, pin=True)
+  result = pool.analyze("image.jpg")          # same dict as inference.analyze()
+  results = pool.map(paths)
+  pool.close()
+
+Workers are started with the "spawn" method, so OMP/MKL thread settings and
+CPU affinity are in place before torch is imported in the child. A worker
+that dies (OOM kill, segfault) fails its outstanding requests and gets no
+new ones.
+
+Usage:
+  python inference_pool.py img1.jpg img2.jpg --workers 4 --threads 2 [--pin]
+  python inference_pool.py --benchmark [--configs 1x8 2x4 4x2 8x1] [--limit 100]
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import queue
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+VALID_DIR = os.path.join(SCRIPT_DIR, 'datasets', 'merged_dataset', 'valid', 'images')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Seconds to wait for every worker to load its model
+STARTUP_TIMEOUT = 300
+# How often the startup wait and the collector check for dead workers (seconds)
+POLL_INTERVAL = 1.0
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_sets(workers, threads, cores=None):
+    """Disjoint (where possible) blocks of `threads` cores, one per worker, wrapping around."""
+    cores = cores or available_cores()
+    return [[cores[(w * threads + t) % len(cores)] for t in range(threads)] for w in range(workers)]
+
+
+def _worker_main(worker_id, threads, cores, backend, requests, results):
+    """Worker process: configure threads/affinity, load the model, then serve requests until None."""
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        import inference
+        if backend:
+            inference.BACKEND = backend
+        inference.get_model()
+    except Exception as e:
+        results.put(('ready', worker_id, str(e)))
+        return
+    results.put(('ready', worker_id, None))
+
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        request_id, source, options = item
+        try:
+            output = inference.analyze(source, **options)
+        except Exception as e:
+            output = {"status": "error", "error": str(e)}
+        results.put(('result', request_id, output))
+
+
+class InferencePool:
+    """Fixed set of model worker processes with least-loaded dispatch (see module docstring)."""
+
+    def __init__(self, workers=2, threads=1, pin=False, backend=None, use_cache=False,
+                 startup_timeout=STARTUP_TIMEOUT):
+        self.workers = workers
+        self.threads = threads
+        self.use_cache = use_cache
+        ctx = mp.get_context('spawn')
+        self._results = ctx.Queue()
+        self._requests = [ctx.Queue() for _ in range(workers)]
+        self._outstanding = [0] * workers
+        self._futures = {}  # request id -> (future, worker)
+        self._dead = set()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._collector = None
+
+        cores = core_sets(workers, threads) if pin else [None] * workers
+        self.cores = cores
+        self._procs = [
+            ctx.Process(target=_worker_main, args=(i, threads, cores[i], backend, self._requests[i], self._results),
+                        daemon=True)
+            for i in range(workers)
+        ]
+        for proc in self._procs:
+            proc.start()
+
+        # Wait for every worker to load its model; a worker that crashes
+        # before reporting (e.g. killed while importing torch) never will
+        errors = []
+        waiting = set(range(workers))
+        deadline = time.monotonic() + startup_timeout
+        while waiting:
+            try:
+                _, worker_id, error = self._results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                for i in sorted(waiting):
+                    if not self._procs[i].is_alive():
+                        waiting.discard(i)
+                        errors.append(f"worker {i}: exited with code {self._procs[i].exitcode}")
+                if waiting and time.monotonic() > deadline:
+                    errors.append(f"workers {sorted(waiting)}: not ready after {startup_timeout} s")
+                    break
+                continue
+            waiting.discard(worker_id)
+            if error:
+                errors.append(f"worker {worker_id}: {error}")
+        if errors:
+            self.close(timeout=0)
+            raise RuntimeError("Inference pool failed to start: " + "; ".join(errors))
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _collect(self):
+        while True:
+            try:
+                item = self._results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                # Only checked when the queue is drained, so results a worker
+                # sent before dying are still delivered
+                self._fail_dead_workers()
+                continue
+            if item is None:
+                return
+            _, request_id, output = item
+            with self._lock:
+                entry = self._futures.pop(request_id, None)
+                if entry is None:
+                    continue  # already failed with its dead worker
+                future, worker = entry
+                self._outstanding[worker] -= 1
+            future.set_result(output)
+
+    def _fail_dead_workers(self):
+        """Fail the outstanding requests of workers that exited, and stop routing to them."""
+        failed = []
+        with self._lock:
+            for worker, proc in enumerate(self._procs):
+                if worker in self._dead or proc.is_alive():
+                    continue
+                self._dead.add(worker)
+                error = RuntimeError(f"Inference worker {worker} exited with code {proc.exitcode}")
+                for request_id, (future, owner) in list(self._futures.items()):
+                    if owner == worker:
+                        del self._futures[request_id]
+                        failed.append((future, error))
+                self._outstanding[worker] = 0
+        for future, error in failed:
+            future.set_exception(error)
+
+    def submit(self, source, annotate=False, tile=False):
+        """Queue one image (path or bytes) on the least-loaded worker; returns a Future."""
+        future = Future()
+        with self._lock:
+            alive = [w for w in range(self.workers) if w not in self._dead]
+            if not alive:
+                raise RuntimeError("Inference pool has no live workers")
+            worker = min(alive, key=self._outstanding.__getitem__)
+            request_id = self._next_id
+            self._next_id += 1
+            self._outstanding[worker] += 1
+            self._futures[request_id] = (future, worker)
+        options = {"annotate": annotate, "tile": tile, "use_cache": self.use_cache}
+        self._requests[worker].put((request_id, source, options))
+        return future
+
+    def analyze(self, source, **options):
+        return self.submit(source, **options).result()
+
+    def map(self, sources, **options):
+        futures = [self.submit(source, **options) for source in sources]
+        return [f.result() for f in futures]
+
+    def loads(self):
+        with self._lock:
+            return list(self._outstanding)
+
+    def close(self, timeout=10):
+        for q in self._requests:
+            q.put(None)
+        for proc in self._procs:
+            proc.join(timeout=timeout)
+            if proc.is_alive():
+                proc.terminate()
+        self._results.put(None)
+        if self._collector is not None:
+            self._collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def valid_images(limit=None):
+    paths = sorted(p for p in glob.glob(os.path.join(VALID_DIR, '*')) if p.lower().endswith(IMAGE_SUFFIXES))
+    return paths[:limit] if limit else paths
+
+
+def default_configs():
+    """workers x threads splits that use every core: 1xN, 2xN/2, ..., Nx1."""
+    cores = len(available_cores())
+    configs, workers = [], 1
+    while workers <= cores:
+        configs.append((workers, cores // workers))
+        workers *= 2
+    return configs
+
+
+def parse_config(text):
+    workers, threads = text.lower().split('x')
+    return int(workers), int(threads)
+
+
+def benchmark(configs, images, pin=False, repeats=1, backend=None):
+    """Total images/sec over `images` for each (workers, threads) config."""
+    report = []
+    for workers, threads in configs:
+        start = time.perf_counter()
+        with InferencePool(workers, threads, pin=pin, backend=backend) as pool:
+            startup = time.perf_counter() - start
+            pool.map(images[:workers])  # warm-up: one image per worker
+            start = time.perf_counter()
+            outputs = pool.map(images * repeats)
+            elapsed = time.perf_counter() - start
+        errors = sum(1 for o in outputs if o.get("status") != "success")
+        row = {
+            "workers": workers,
+            "threads": threads,
+            "pinned": pin,
+            "startup_s": round(startup, 2),
+            "images": len(outputs),
+            "errors": errors,
+            "images_per_sec": round(len(outputs) / elapsed, 2),
+        }
+        print(f"{workers:>3} workers x {threads:>2} threads | {row['images_per_sec']:>8} img/s | "
+              f"startup {row['startup_s']} s | errors {errors}")
+        report.append(row)
+    best = max(report, key=lambda r: r["images_per_sec"])
+    print(f"Best: {best['workers']} workers x {best['threads']} threads ({best['images_per_sec']} img/s)")
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi-process inference pool with per-worker threads and core pinning.")
+    parser.add_argument('images', nargs='*')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=1, help="torch intra-op threads per worker")
+    parser.add_argument('--pin', action='store_true', help="Pin each worker to its own block of cores")
+    parser.add_argument('--backend', default=None, help="inference.py backend (default: $RICE_INFERENCE_BACKEND or torch)")
+    parser.add_argument('--benchmark', action='store_true', help="Compare workers x threads configs on the valid split")
+    parser.add_argument('--configs', nargs='+', type=parse_config, default=None, help="e.g. 1x8 2x4 4x2 8x1")
+    parser.add_argument('--limit', type=int, default=100, help="Benchmark: number of valid images")
+    parser.add_argument('--repeats', type=int, default=1, help="Benchmark: passes over the images")
+    parser.add_argument('--out', default=None, help="Benchmark: also write the JSON report here")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.benchmark:
+        images = valid_images(args.limit)
+        if not images:
+            print(f"No images found in {VALID_DIR}")
+            sys.exit(1)
+        configs = args.configs or default_configs()
+        print("=" * 60)
+        print("RICE QUALITY INFERENCE POOL BENCHMARK")
+        print("=" * 60)
+        print(f"Images: {len(images)} x {args.repeats} | Cores: {len(available_cores())} | Pinned: {args.pin}")
+        print("=" * 60)
+        report = benchmark(configs, images, pin=args.pin, repeats=args.repeats, backend=args.backend)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump({"cores": len(available_cores()), "results": report}, f, indent=2)
+        sys.exit(0)
+
+    if not args.images:
+        print(json.dumps({"error": "No image path provided"}))
+        sys.exit(1)
+    with InferencePool(args.workers, args.threads, pin=args.pin, backend=args.backend) as pool:
+        for output in pool.map(args.images):
+            print(json.dumps(output))
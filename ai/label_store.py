@@ -0,0 +1,238 @@
+"""
+Packed, columnar store for YOLO detection labels.
+
+Instead of one small .txt file per image, a split's labels live in a single
+uncompressed .npz (labels.npz) with flat arrays:
+
+  stems   : (M,)   image stems, in store order
+  offsets : (M+1,) int64, boxes of image i are rows offsets[i]:offsets[i+1]
+  cls     : (N,)   int16 class ids
+  boxes   : (N, 4) float32 normalized x_center, y_center, width, height
+
+Per-image lookups are a slice, whole-dataset work (class counts, box size
+histograms, remapping) is a single numpy operation over N boxes, and class
+remapping is a lookup table (see class_lut) instead of a dict per line.
+YOLO .txt files can be read into a store (from_yolo_dir) and written back
+out (to_yolo_dir), so ultralytics training keeps working unchanged.
+
+Usage:
+  python label_store.py pack   <labels_dir> <out.npz>
+  python label_store.py export <store.npz>  <labels_dir>
+  python -m doctest label_store.py        (parser self-check, incl. polygon lines)
+"""
+
+import os
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+STORE_NAME = "labels.npz"
+
+
+def class_lut(class_map: dict) -> np.ndarray:
+    """Dict {src_cls: dst_cls or None} -> int16 lookup array, -1 meaning 'drop'."""
+    lut = np.full(max(class_map) + 1 if class_map else 0, -1, dtype=np.int16)
+    for src, dst in class_map.items():
+        if dst is not None:
+            lut[src] = dst
+    return lut
+
+
+def polygon_box(coords: np.ndarray) -> np.ndarray:
+    """Normalized x1 y1 x2 y2 ... polygon -> its enclosing box as x_center, y_center, width, height."""
+    xs, ys = coords[0::2], coords[1::2]
+    x0, x1, y0, y1 = xs.min(), xs.max(), ys.min(), ys.max()
+    return np.array([(x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0], dtype=np.float32)
+
+
+def parse_yolo_text(text: str):
+    r"""
+    Parse the contents of a YOLO label file. Returns (cls int16 (n,), boxes float32 (n, 4)).
+    Lines with extra columns (segment polygons) become the min/max box of their
+    vertices, the same box ultralytics derives from a segment.
+
+    >>> cls, boxes = parse_yolo_text("1 0.5 0.5 0.2 0.1\n0 0.1 0.2 0.3 0.2 0.3 0.4 0.1 0.4\n")
+    >>> cls.tolist()
+    [1, 0]
+    >>> [round(v, 4) for v in boxes[1].tolist()]
+    [0.2, 0.3, 0.2, 0.2]
+    """
+    values = np.array(text.split(), dtype=np.float32)
+    lines = [line.split() for line in text.splitlines() if line.strip()]
+    if values.size == len(lines) * 5:
+        table = values.reshape(-1, 5)
+        return table[:, 0].astype(np.int16), np.ascontiguousarray(table[:, 1:])
+
+    cls = np.zeros(len(lines), dtype=np.int16)
+    boxes = np.zeros((len(lines), 4), dtype=np.float32)
+    for i, parts in enumerate(lines):
+        row = np.array(parts, dtype=np.float32)
+        cls[i] = int(row[0])
+        boxes[i] = row[1:5] if len(row) == 5 else polygon_box(row[1:])
+    return cls, boxes
+
+
+def read_yolo_file(path):
+    """parse_yolo_text for a file; a missing file is an image without labels."""
+    try:
+        text = Path(path).read_text()
+    except FileNotFoundError:
+        text = ""
+    return parse_yolo_text(text)
+
+
+def map_classes(cls: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Class ids through a class_lut; ids outside the table map to -1 (drop)."""
+    new_cls = np.full(len(cls), -1, dtype=np.int16)
+    in_range = (cls >= 0) & (cls < len(lut))
+    new_cls[in_range] = lut[cls[in_range]]
+    return new_cls
+
+
+def remap(cls: np.ndarray, boxes: np.ndarray, lut: np.ndarray):
+    """Apply a class_lut to one image's labels, dropping unmapped classes."""
+    new_cls = map_classes(cls, lut)
+    keep = new_cls >= 0
+    return new_cls[keep], boxes[keep]
+
+
+def format_yolo_lines(cls: np.ndarray, boxes: np.ndarray) -> str:
+    return "\n".join(f"{c} {x:.6f} {y:.6f} {w:.6f} {h:.6f}"
+                     for c, (x, y, w, h) in zip(cls.tolist(), boxes.tolist()))
+
+
+class LabelStore:
+    """Labels of many images packed into flat arrays (see module docstring)."""
+
+    def __init__(self, stems, offsets, cls, boxes):
+        self.stems = np.asarray(stems, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.cls = np.asarray(cls, dtype=np.int16)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self._index = None
+
+    # ── Construction ─────────────────────────────────────────────────────────
+
+    @classmethod
+    def from_items(cls, items):
+        """Build from an iterable of (stem, cls (n,), boxes (n, 4))."""
+        stems, cls_parts, box_parts, sizes = [], [], [], []
+        for stem, c, b in items:
+            stems.append(stem)
+            cls_parts.append(np.asarray(c, dtype=np.int16).reshape(-1))
+            box_parts.append(np.asarray(b, dtype=np.float32).reshape(-1, 4))
+            sizes.append(len(cls_parts[-1]))
+        offsets = np.zeros(len(stems) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        return cls(
+            stems, offsets,
+            np.concatenate(cls_parts) if cls_parts else np.zeros(0, np.int16),
+            np.concatenate(box_parts) if box_parts else np.zeros((0, 4), np.float32),
+        )
+
+    @classmethod
+    def from_yolo_dir(cls, labels_dir, stems=None):
+        """Pack a directory of YOLO .txt files (or just the given stems)."""
+        labels_dir = Path(labels_dir)
+        if stems is None:
+            stems = sorted(p.stem for p in labels_dir.glob("*.txt"))
+        return cls.from_items((s, *read_yolo_file(labels_dir / f"{s}.txt")) for s in stems)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["stems"], data["offsets"], data["cls"], data["boxes"])
+
+    def save(self, path):
+        """Write atomically (uncompressed, so loading is a plain read)."""
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp.npz")
+        np.savez(tmp, stems=self.stems, offsets=self.offsets, cls=self.cls, boxes=self.boxes)
+        os.replace(tmp, path)
+
+    # ── Access ───────────────────────────────────────────────────────────────
+
+    def __len__(self):
+        return len(self.stems)
+
+    @property
+    def num_boxes(self):
+        return int(self.offsets[-1])
+
+    @property
+    def image_idx(self) -> np.ndarray:
+        """(N,) index of the image each box belongs to."""
+        return np.repeat(np.arange(len(self.stems)), np.diff(self.offsets))
+
+    def index_of(self, stem):
+        if self._index is None:
+            self._index = {s: i for i, s in enumerate(self.stems.tolist())}
+        return self._index.get(stem)
+
+    def labels(self, i):
+        """(cls, boxes) of the i-th image (views, no copy)."""
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return self.cls[lo:hi], self.boxes[lo:hi]
+
+    def get(self, stem):
+        """(cls, boxes) for a stem, or None if the stem is not in the store."""
+        i = self.index_of(stem)
+        return None if i is None else self.labels(i)
+
+    def items(self):
+        for i, stem in enumerate(self.stems.tolist()):
+            yield (stem, *self.labels(i))
+
+    def class_counts(self, nc=2) -> np.ndarray:
+        """(M, nc) per-image box count per class."""
+        valid = (self.cls >= 0) & (self.cls < nc)
+        flat = self.image_idx[valid] * nc + self.cls[valid]
+        return np.bincount(flat, minlength=len(self.stems) * nc).reshape(len(self.stems), nc)
+
+    # ── Whole-store operations ───────────────────────────────────────────────
+
+    def remap(self, lut: np.ndarray, drop_empty=False):
+        """New store with classes mapped through a class_lut, in one pass over all boxes."""
+        new_cls = map_classes(self.cls, lut)
+        keep = new_cls >= 0
+        sizes = np.bincount(self.image_idx[keep], minlength=len(self.stems))
+        stems = self.stems
+        if drop_empty:
+            stems = stems[sizes > 0]
+            sizes = sizes[sizes > 0]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        return LabelStore(stems, offsets, new_cls[keep], self.boxes[keep])
+
+    def to_yolo_dir(self, labels_dir):
+        """Write one YOLO .txt per image (for ultralytics or other YOLO tooling)."""
+        labels_dir = Path(labels_dir)
+        labels_dir.mkdir(parents=True, exist_ok=True)
+        for stem, c, b in self.items():
+            (labels_dir / f"{stem}.txt").write_text(format_yolo_lines(c, b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack YOLO label files into a labels.npz store, or export one back.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    pack = sub.add_parser("pack", help="labels_dir/*.txt -> store")
+    pack.add_argument("labels_dir")
+    pack.add_argument("out")
+    export = sub.add_parser("export", help="store -> labels_dir/*.txt")
+    export.add_argument("store")
+    export.add_argument("labels_dir")
+    args = parser.parse_args()
+
+    if args.cmd == "pack":
+        store = LabelStore.from_yolo_dir(args.labels_dir)
+        store.save(args.out)
+        print(f"Packed {len(store)} label files ({store.num_boxes} boxes) into {args.out}")
+    else:
+        store = LabelStore.load(args.store)
+        store.to_yolo_dir(args.labels_dir)
+        print(f"Wrote {len(store)} label files ({store.num_boxes} boxes) to {args.labels_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,25 +9,55 @@ Sources:
   - generated_train       : already labeled (0=Full, 1=Broken)
   - Rice-Quality 3        : remap sound/whole-chalky→0, broken-chalky/broken-clear/unsound→1, skip rest
   - Counting Rice Grains  : all varieties are whole grains → 0 (Full)
+
+The merge is incremental: merged_dataset/merge_manifest.json records, for
+every output stem, the source image/label size and mtime, the class map and
+the split it went to. Re-running only processes new or changed samples,
+removes outputs whose source disappeared, and keeps every existing sample
+in its split. Images are hardlinked into the output (falling back to a
+copy across filesystems) and label remapping/writes run in a thread pool.
+--full re-processes every sample (still in its recorded split) and then
+deletes any output file the new manifest does not list.
+
+Besides the per-image YOLO .txt files (what ultralytics trains on), every
+split gets a packed labels.npz (see label_store.py) for fast stats and
+tooling. Class remapping is a vectorized lookup table per source.
+
+Near-duplicates (Roboflow augmentations of one photo, perceptually identical
+images) are clustered and each cluster is kept inside a single split, so
+validation images do not leak into training (see near_duplicates.py).
 """
 
 import os
+import json
 import shutil
-import random
+import hashlib
+import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import label_store
 
 # ── Paths ────────────────────────────────────────────────────────────────────
 BASE = Path(__file__).parent
 DATASETS_DIR = BASE / "datasets"
 OUTPUT_DIR   = DATASETS_DIR / "merged_dataset"
+MANIFEST_PATH = OUTPUT_DIR / "merge_manifest.json"
 
 TRAIN_IMG = OUTPUT_DIR / "train" / "images"
 TRAIN_LBL = OUTPUT_DIR / "train" / "labels"
 VAL_IMG   = OUTPUT_DIR / "valid" / "images"
 VAL_LBL   = OUTPUT_DIR / "valid" / "labels"
 
-for d in [TRAIN_IMG, TRAIN_LBL, VAL_IMG, VAL_LBL]:
-    d.mkdir(parents=True, exist_ok=True)
+SPLIT_DIRS = {
+    "train": (TRAIN_IMG, TRAIN_LBL),
+    "valid": (VAL_IMG, VAL_LBL),
+}
+TRAIN_FRACTION = 0.8
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp"}
+MANIFEST_VERSION = 1
 
 # ── Class remapping definitions ───────────────────────────────────────────────
 
@@ -49,96 +79,333 @@ COUNTING_MAP = {0: 0, 1: 0, 2: 0}
 # generated_train: already correct (0=Full, 1=Broken)
 GENERATED_MAP = {0: 0, 1: 1}
 
+RQ3_DIR = DATASETS_DIR / "Rice-Quality 3.v4i.yolov8"
+CRG_DIR = DATASETS_DIR / "Counting Rice Grains.v9i.yolov8"
+
+
+def source_dirs():
+    """(prefix, images_dir, labels_dir, class_map) for every source split, in merge order."""
+    sources = [("gen", DATASETS_DIR / "generated_train" / "images",
+                DATASETS_DIR / "generated_train" / "labels", GENERATED_MAP)]
+    for base, name, class_map in [(RQ3_DIR, "rq3", RICE_QUALITY_MAP), (CRG_DIR, "crg", COUNTING_MAP)]:
+        for split in ["train", "valid", "test"]:
+            sources.append((f"{name}_{split}", base / split / "images", base / split / "labels", class_map))
+    return sources
+
 # ── Helper functions ──────────────────────────────────────────────────────────
 
-def remap_label_file(src_label: Path, class_map: dict) -> list[str]:
-    """Read a YOLO label file and remap class IDs. Returns remapped lines."""
-    lines = []
-    if not src_label.exists():
-        return lines
-    for line in src_label.read_text().strip().splitlines():
-        parts = line.strip().split()
-        if not parts:
+_luts = {}
+
+
+def remap_labels(src_label: Path, class_map: dict):
+    """Read a YOLO label file and remap class IDs. Returns (cls, boxes) of the kept annotations."""
+    key = map_fingerprint(class_map)
+    if key not in _luts:
+        _luts[key] = label_store.class_lut(class_map)
+    cls, boxes = label_store.read_yolo_file(src_label)
+    return label_store.remap(cls, boxes, _luts[key])
+
+
+def map_fingerprint(class_map: dict) -> str:
+    """Short, stable id of a class map, so edits to a map re-process its samples."""
+    return hashlib.sha1(json.dumps(sorted(class_map.items()), default=str).encode()).hexdigest()[:12]
+
+
+def file_stamp(path: Path):
+    """(size, mtime_ns) of a file, or None if it does not exist."""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def scan_sources():
+    """
+    Stat every source sample without reading it.
+    Returns ({stem: entry}, missing_prefixes) where entry holds the source
+    paths, their stamps and the class map to apply, and missing_prefixes are
+    sources whose directory is absent on this machine.
+    """
+    samples = {}
+    missing = set()
+    for prefix, images_dir, labels_dir, class_map in source_dirs():
+        if not images_dir.exists():
+            missing.add(prefix)
             continue
-        cls = int(parts[0])
-        new_cls = class_map.get(cls)
-        if new_cls is None:
-            continue  # skip this annotation
-        lines.append(f"{new_cls} " + " ".join(parts[1:]))
-    return lines
-
-
-def collect_samples(images_dir: Path, labels_dir: Path, class_map: dict, prefix: str):
-    """Return list of (image_path, remapped_label_lines, unique_stem) tuples."""
-    samples = []
-    for img_path in sorted(images_dir.glob("*")):
-        if img_path.suffix.lower() not in {".jpg", ".jpeg", ".png", ".bmp"}:
+        fingerprint = map_fingerprint(class_map)
+        for img_path in sorted(images_dir.iterdir()):
+            if img_path.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            lbl_path = labels_dir / (img_path.stem + ".txt")
+            samples[f"{prefix}_{img_path.stem}"] = {
+                "src": str(img_path),
+                "src_stamp": file_stamp(img_path),
+                "label": str(lbl_path),
+                "label_stamp": file_stamp(lbl_path),
+                "map": fingerprint,
+                "suffix": img_path.suffix,
+                "class_map": class_map,
+            }
+    return samples, missing
+
+
+def stem_prefix(stem: str) -> str:
+    """Source prefix of an output stem ('gen', 'rq3_train', 'crg_valid', ...)."""
+    if stem.startswith("gen_"):
+        return "gen"
+    return "_".join(stem.split("_", 2)[:2])
+
+
+def load_manifest():
+    if not MANIFEST_PATH.exists():
+        return {}
+    try:
+        manifest = json.loads(MANIFEST_PATH.read_text())
+    except ValueError:
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("samples", {})
+
+
+def save_manifest(samples: dict):
+    tmp = MANIFEST_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"version": MANIFEST_VERSION, "samples": samples}, indent=1, sort_keys=True))
+    os.replace(tmp, MANIFEST_PATH)
+
+
+def existing_split(stem: str):
+    """Split an already-merged stem lives in (used to adopt a merge made before the manifest existed)."""
+    for split, (_, lbl_dir) in SPLIT_DIRS.items():
+        if (lbl_dir / f"{stem}.txt").exists():
+            return split
+    return None
+
+
+def hash_split(key: str) -> str:
+    """Stable 80/20 assignment that does not move existing samples when new ones are added."""
+    bucket = int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) % 1000
+    return "train" if bucket < TRAIN_FRACTION * 1000 else "valid"
+
+
+def is_unchanged(stem: str, entry: dict, previous: dict) -> bool:
+    if not previous:
+        return False
+    if (previous.get("src_stamp") != entry["src_stamp"]
+            or previous.get("label_stamp") != entry["label_stamp"]
+            or previous.get("map") != entry["map"]):
+        return False
+    if previous.get("skipped"):
+        return True
+    img_dir, lbl_dir = SPLIT_DIRS[previous["split"]]
+    return (img_dir / f"{stem}{entry['suffix']}").exists() and (lbl_dir / f"{stem}.txt").exists()
+
+
+def link_or_copy(src: Path, dst: Path, use_links=True):
+    """Hardlink src to dst (no bytes copied); fall back to a copy across filesystems."""
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    if use_links:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def remove_outputs(stem: str, suffix: str, split: str):
+    img_dir, lbl_dir = SPLIT_DIRS[split]
+    for path in (img_dir / f"{stem}{suffix}", lbl_dir / f"{stem}.txt"):
+        if path.exists():
+            path.unlink()
+
+
+def write_sample(stem: str, entry: dict, split: str, use_links=True):
+    """
+    Remap one sample's labels and write it into `split`.
+    Returns (manifest record, (cls, boxes)).
+    """
+    cls, boxes = remap_labels(Path(entry["label"]), entry["class_map"])
+    record = {k: v for k, v in entry.items() if k != "class_map"}
+    record["stem"] = stem
+    record["split"] = split
+    if len(cls) == 0:
+        # No valid annotations after remapping: remember that so it is not re-read next time
+        record["skipped"] = True
+        for s in SPLIT_DIRS:
+            remove_outputs(stem, entry["suffix"], s)
+        return record, (cls, boxes)
+
+    img_dir, lbl_dir = SPLIT_DIRS[split]
+    link_or_copy(Path(entry["src"]), img_dir / f"{stem}{entry['suffix']}", use_links)
+    (lbl_dir / f"{stem}.txt").write_text(label_store.format_yolo_lines(cls, boxes))
+    record["counts"] = np.bincount(cls, minlength=2)[:2].tolist()
+    return record, (cls, boxes)
+
+
+def merge(workers=8, full=False, use_links=True, dedup_threshold=None):
+    for d in [TRAIN_IMG, TRAIN_LBL, VAL_IMG, VAL_LBL]:
+        d.mkdir(parents=True, exist_ok=True)
+
+    previous = load_manifest()
+    current, missing = scan_sources()
+
+    per_source = {}
+    for stem in current:
+        source = stem.split("_", 1)[0]
+        per_source[source] = per_source.get(source, 0) + 1
+    print(f"generated_train:     {per_source.get('gen', 0)} source images")
+    print(f"Rice-Quality 3:      {per_source.get('rq3', 0)} source images")
+    print(f"Counting Rice Grains:{per_source.get('crg', 0)} source images")
+
+    # ── Decide what to do with every sample ──────────────────────────────────
+    manifest = {}
+    todo = []  # (stem, entry, split)
+    for stem, entry in current.items():
+        prev = previous.get(stem)
+        if not full and is_unchanged(stem, entry, prev):
+            manifest[stem] = prev
             continue
-        lbl_path = labels_dir / (img_path.stem + ".txt")
-        lines = remap_label_file(lbl_path, class_map)
-        if not lines:
-            continue  # skip images with no valid annotations after remapping
-        stem = f"{prefix}_{img_path.stem}"
-        samples.append((img_path, lines, stem, img_path.suffix))
-    return samples
-
-
-def write_sample(img_path: Path, label_lines: list, stem: str, suffix: str,
-                 img_dir: Path, lbl_dir: Path):
-    shutil.copy2(img_path, img_dir / f"{stem}{suffix}")
-    (lbl_dir / f"{stem}.txt").write_text("\n".join(label_lines))
-
-
-# ── Collect all samples ───────────────────────────────────────────────────────
-all_samples = []
-
-# 1. generated_train (existing labeled data)
-gen_img = DATASETS_DIR / "generated_train" / "images"
-gen_lbl = DATASETS_DIR / "generated_train" / "labels"
-all_samples += collect_samples(gen_img, gen_lbl, GENERATED_MAP, "gen")
-print(f"generated_train:     {len([s for s in all_samples if s[2].startswith('gen')])} samples")
-
-# 2. Rice-Quality 3
-rq3_base = DATASETS_DIR / "Rice-Quality 3.v4i.yolov8"
-before = len(all_samples)
-for split in ["train", "valid", "test"]:
-    img_d = rq3_base / split / "images"
-    lbl_d = rq3_base / split / "labels"
-    if img_d.exists():
-        all_samples += collect_samples(img_d, lbl_d, RICE_QUALITY_MAP, f"rq3_{split}")
-print(f"Rice-Quality 3:      {len(all_samples) - before} samples")
-
-# 3. Counting Rice Grains
-crg_base = DATASETS_DIR / "Counting Rice Grains.v9i.yolov8"
-before = len(all_samples)
-for split in ["train", "valid", "test"]:
-    img_d = crg_base / split / "images"
-    lbl_d = crg_base / split / "labels"
-    if img_d.exists():
-        all_samples += collect_samples(img_d, lbl_d, COUNTING_MAP, f"crg_{split}")
-print(f"Counting Rice Grains:{len(all_samples) - before} samples")
-
-print(f"\nTotal samples collected: {len(all_samples)}")
-
-# ── Train / Val split (80/20) ─────────────────────────────────────────────────
-random.seed(42)
-random.shuffle(all_samples)
-
-split_idx  = int(len(all_samples) * 0.8)
-train_set  = all_samples[:split_idx]
-val_set    = all_samples[split_idx:]
-
-print(f"Train: {len(train_set)} | Val: {len(val_set)}")
-
-# ── Write files ───────────────────────────────────────────────────────────────
-for img_path, label_lines, stem, suffix in train_set:
-    write_sample(img_path, label_lines, stem, suffix, TRAIN_IMG, TRAIN_LBL)
-
-for img_path, label_lines, stem, suffix in val_set:
-    write_sample(img_path, label_lines, stem, suffix, VAL_IMG, VAL_LBL)
-
-# ── Write data.yaml ───────────────────────────────────────────────────────────
-yaml_content = f"""path: {OUTPUT_DIR}
+        split = (prev or {}).get("split") or existing_split(stem) or hash_split(stem)
+        todo.append((stem, entry, split))
+
+    # A source directory that is absent here (e.g. not downloaded) keeps its merged samples
+    for stem, prev in previous.items():
+        if stem not in current and stem_prefix(stem) in missing:
+            manifest[stem] = prev
+
+    removed = [stem for stem in previous if stem not in current and stem not in manifest]
+    for stem in removed:
+        prev = previous[stem]
+        if not prev.get("skipped"):
+            remove_outputs(stem, prev["suffix"], prev["split"])
+
+    unchanged = len(manifest)
+    print(f"\nUnchanged: {unchanged} | New/changed: {len(todo)} | Removed: {len(removed)}")
+
+    # ── Write new/changed samples in parallel ────────────────────────────────
+    fresh = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda t: write_sample(t[0], t[1], t[2], use_links), todo)
+        for record, labels in results:
+            manifest[record["stem"]] = record
+            fresh[record["stem"]] = labels
+
+    if dedup_threshold is not None:
+        keep_duplicates_together(manifest, dedup_threshold, workers)
+
+    if full:
+        print(f"Pruned {prune_outputs(manifest)} stale output files")
+
+    save_manifest(manifest)
+    write_label_stores(manifest, fresh)
+    write_data_yaml()
+    return manifest
+
+
+def prune_outputs(manifest: dict) -> int:
+    """
+    Delete split images/labels no manifest record accounts for: leftovers of an
+    older merge (renamed sources, a lost manifest, copies in the wrong split).
+    Returns the number of files removed.
+    """
+    expected = {split: set() for split in SPLIT_DIRS}
+    for stem, record in manifest.items():
+        if not record.get("skipped"):
+            expected[record["split"]].update((f"{stem}{record['suffix']}", f"{stem}.txt"))
+
+    pruned = 0
+    for split, dirs in SPLIT_DIRS.items():
+        for d in dirs:
+            for path in d.iterdir():
+                if path.is_file() and path.name not in expected[split]:
+                    path.unlink()
+                    pruned += 1
+    return pruned
+
+
+def move_sample(stem: str, record: dict, split: str):
+    src_img, src_lbl = SPLIT_DIRS[record["split"]]
+    dst_img, dst_lbl = SPLIT_DIRS[split]
+    os.replace(src_img / f"{stem}{record['suffix']}", dst_img / f"{stem}{record['suffix']}")
+    os.replace(src_lbl / f"{stem}.txt", dst_lbl / f"{stem}.txt")
+    record["split"] = split
+
+
+def keep_duplicates_together(manifest: dict, threshold: int, workers=8):
+    """
+    Cluster near-duplicate samples (perceptual hash within `threshold` bits, or
+    Roboflow variants of one photo) and move every cluster into a single split:
+    the split most of its members are already in (hash of the cluster on a tie).
+    Hashes are stored in the manifest, so only new/changed samples are hashed.
+    """
+    from near_duplicates import compute_hashes, find_clusters, leakage_report
+
+    kept = {stem: r for stem, r in manifest.items() if not r.get("skipped")}
+    to_hash = [stem for stem, r in kept.items() if r.get("phash") is None]
+    paths = [SPLIT_DIRS[kept[s]["split"]][0] / f"{s}{kept[s]['suffix']}" for s in to_hash]
+    for stem, h in zip(to_hash, compute_hashes(paths, workers)):
+        kept[stem]["phash"] = None if h is None else f"{h:016x}"
+
+    stems = sorted(kept)
+    hashes = [None if kept[s].get("phash") is None else int(kept[s]["phash"], 16) for s in stems]
+    clusters = find_clusters(stems, hashes, threshold)
+    before = leakage_report(clusters, {s: kept[s]["split"] for s in stems})
+
+    moved = 0
+    for cluster in clusters:
+        if len(cluster) < 2:
+            continue
+        in_train = sum(1 for s in cluster if kept[s]["split"] == "train")
+        in_valid = len(cluster) - in_train
+        if in_train == 0 or in_valid == 0:
+            continue
+        if in_train != in_valid:
+            target = "train" if in_train > in_valid else "valid"
+        else:
+            target = hash_split(min(cluster))
+        for stem in cluster:
+            if kept[stem]["split"] != target:
+                move_sample(stem, kept[stem], target)
+                moved += 1
+
+    print(f"\nNear-duplicate clusters: {before['duplicate_clusters']} "
+          f"({before['leaking_clusters']} spanning train/valid, {moved} images moved)")
+
+
+def write_label_stores(manifest: dict, fresh: dict):
+    """
+    Write <split>/labels.npz for every split. Labels of unchanged samples are
+    taken from the previous stores, so only new/changed samples were parsed.
+    """
+    previous = []
+    for split in SPLIT_DIRS:
+        path = OUTPUT_DIR / split / label_store.STORE_NAME
+        if path.exists():
+            try:
+                previous.append(label_store.LabelStore.load(path))
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def labels_of(stem, split):
+        if stem in fresh:
+            return fresh[stem]
+        for store in previous:
+            found = store.get(stem)
+            if found is not None:
+                return found
+        return label_store.read_yolo_file(SPLIT_DIRS[split][1] / f"{stem}.txt")
+
+    for split in SPLIT_DIRS:
+        stems = sorted(s for s, r in manifest.items() if not r.get("skipped") and r["split"] == split)
+        store = label_store.LabelStore.from_items((s, *labels_of(s, split)) for s in stems)
+        store.save(OUTPUT_DIR / split / label_store.STORE_NAME)
+
+
+def write_data_yaml():
+    yaml_content = f"""path: {OUTPUT_DIR}
 train: train/images
 val: valid/images
 
@@ -147,20 +414,33 @@ names:
   0: Full
   1: Broken
 """
-(OUTPUT_DIR / "data.yaml").write_text(yaml_content)
-
-# ── Class distribution stats ──────────────────────────────────────────────────
-full_count = broken_count = 0
-for _, lines, _, _ in all_samples:
-    for line in lines:
-        cls = int(line.split()[0])
-        if cls == 0:
-            full_count += 1
-        else:
-            broken_count += 1
+    (OUTPUT_DIR / "data.yaml").write_text(yaml_content)
+
+
+def print_summary(manifest: dict):
+    from dataset_stats import dataset_stats, print_summary as print_stats
+
+    kept = [r for r in manifest.values() if not r.get("skipped")]
+    print(f"\nTotal samples: {len(kept)}\n")
+    print_stats(dataset_stats(OUTPUT_DIR))
+    print(f"\nMerged dataset written to: {OUTPUT_DIR}")
+    print("Ready to train!")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Incrementally merge rice datasets into merged_dataset.")
+    parser.add_argument("--workers", type=int, default=8, help="Threads for label remapping and file writes")
+    parser.add_argument("--full", action="store_true",
+                        help="Re-process every sample and delete output files not in the new manifest")
+    parser.add_argument("--copy", action="store_true", help="Copy images instead of hardlinking them")
+    parser.add_argument("--dedup-threshold", type=int, default=6,
+                        help="Max perceptual-hash distance (bits) for near-duplicates kept in one split")
+    parser.add_argument("--no-dedup", action="store_true", help="Skip near-duplicate clustering")
+    return parser.parse_args()
+
 
-print(f"\nAnnotation breakdown:")
-print(f"  Full grains:   {full_count}")
-print(f"  Broken grains: {broken_count}")
-print(f"\nMerged dataset written to: {OUTPUT_DIR}")
-print("Ready to train!")
+if __name__ == "__main__":
+    args = parse_args()
+    manifest = merge(workers=args.workers, full=args.full, use_links=not args.copy,
+                     dedup_threshold=None if args.no_dedup else args.dedup_threshold)
+    print_summary(manifest)
@@ -0,0 +1,197 @@
+"""
+Perceptual-hash near-duplicate detection for the merged dataset.
+
+Roboflow exports contain augmented near-copies of the same photo (the
+`<name>_jpg.rf.<hash>` variants), so a random split can put near-identical
+images on both sides and inflate validation mAP. This module finds those
+groups so merge_datasets.py can keep every group inside one split:
+
+  - phash(): 64-bit DCT perceptual hash, computed in parallel threads
+    (OpenCV releases the GIL while decoding)
+  - MultiIndexHash: Hamming-distance index, so finding every neighbour within
+    a few bits costs a handful of dict lookups instead of comparing all pairs
+  - find_clusters(): union-find over near-hash pairs plus Roboflow variants
+    of the same source photo
+
+Run directly to check the current merged_dataset for train/valid leakage:
+  python near_duplicates.py [--threshold 6]
+"""
+
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+HASH_THRESHOLD = 6  # max differing bits (of 64) for two images to count as near-duplicates
+
+
+def phash(image_path) -> int:
+    """
+    64-bit perceptual hash: low-frequency 8x8 DCT block of a 32x32 grayscale
+    thumbnail, thresholded at its median. Returns None if the image can't be read.
+    """
+    img = cv2.imread(str(image_path), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if img is None:
+        return None
+    small = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    block = cv2.dct(small)[:8, :8].flatten()
+    bits = block > np.median(block[1:])  # the DC term would skew the median
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def compute_hashes(paths, workers=8):
+    """phash for every path, in input order."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(phash, paths))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over 64-bit hashes (Norouzi et al.).
+
+    Each hash is split into `chunks` 16-bit substrings, each indexed in its own
+    dict. If two hashes differ by <= radius bits, then by pigeonhole at least
+    one substring differs by <= radius // chunks bits, so a query only looks up
+    the substrings within that small radius and verifies the candidates it
+    finds. Lookups cost a few dict probes instead of a scan over all hashes.
+    """
+
+    def __init__(self, radius, chunks=4):
+        self.radius = radius
+        self.chunks = chunks
+        self.bits = 64 // chunks
+        self.sub_radius = radius // chunks
+        self.mask = (1 << self.bits) - 1
+        self.tables = [{} for _ in range(chunks)]
+        self.values = []
+        # Bit flips to try for each substring: all patterns of <= sub_radius bits
+        self.flips = [0]
+        for _ in range(self.sub_radius):
+            self.flips = sorted({f | (1 << b) for f in self.flips for b in range(self.bits)})
+
+    def _substrings(self, value):
+        return [(value >> (i * self.bits)) & self.mask for i in range(self.chunks)]
+
+    def add(self, value: int, item):
+        self.values.append((value, item))
+        idx = len(self.values) - 1
+        for table, sub in zip(self.tables, self._substrings(value)):
+            table.setdefault(sub, []).append(idx)
+
+    def query(self, value: int):
+        """All items whose hash is within `radius` bits of value."""
+        candidates = set()
+        for table, sub in zip(self.tables, self._substrings(value)):
+            for flip in self.flips:
+                candidates.update(table.get(sub ^ flip, ()))
+        return [self.values[i][1] for i in candidates if hamming(value, self.values[i][0]) <= self.radius]
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+
+def roboflow_source(stem: str):
+    """
+    Source-photo key of a Roboflow export stem, e.g.
+    'crg_train_riceee_mp4-11_jpg.rf.0a47...' -> ('crg', 'riceee_mp4-11_jpg').
+    Returns None for stems that are not Roboflow variants.
+    """
+    if ".rf." not in stem:
+        return None
+    base = stem.split(".rf.", 1)[0]
+    parts = base.split("_", 2)
+    if len(parts) < 3:
+        return None
+    return parts[0], parts[2]
+
+
+def find_clusters(stems, hashes, threshold=HASH_THRESHOLD):
+    """
+    Group stems into near-duplicate clusters.
+    Two samples join a cluster if their hashes differ by <= threshold bits or
+    they are Roboflow variants of the same source photo.
+    Returns a list of clusters (lists of stems), singletons included.
+    """
+    uf = UnionFind(len(stems))
+
+    index = MultiIndexHash(threshold)
+    for i, h in enumerate(hashes):
+        if h is None:
+            continue
+        for j in index.query(h):
+            uf.union(i, j)
+        index.add(h, i)
+
+    first_variant = {}
+    for i, stem in enumerate(stems):
+        key = roboflow_source(stem)
+        if key is None:
+            continue
+        if key in first_variant:
+            uf.union(i, first_variant[key])
+        else:
+            first_variant[key] = i
+
+    groups = {}
+    for i, stem in enumerate(stems):
+        groups.setdefault(uf.find(i), []).append(stem)
+    return list(groups.values())
+
+
+def leakage_report(clusters, split_of):
+    """Clusters whose members sit in more than one split."""
+    leaking = [c for c in clusters if len({split_of[s] for s in c}) > 1]
+    return {
+        "clusters": len(clusters),
+        "duplicate_clusters": sum(1 for c in clusters if len(c) > 1),
+        "leaking_clusters": len(leaking),
+        "leaking_images": sum(len(c) for c in leaking),
+        "examples": [sorted(c)[:4] for c in leaking[:5]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check merged_dataset for near-duplicate train/valid leakage.")
+    parser.add_argument("--dataset", default=str(Path(__file__).parent / "datasets" / "merged_dataset"))
+    parser.add_argument("--threshold", type=int, default=HASH_THRESHOLD)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    stems, paths, split_of = [], [], {}
+    for split in ("train", "valid"):
+        for path in sorted((Path(args.dataset) / split / "images").glob("*")):
+            stems.append(path.stem)
+            paths.append(path)
+            split_of[path.stem] = split
+
+    hashes = compute_hashes(paths, args.workers)
+    clusters = find_clusters(stems, hashes, args.threshold)
+    report = leakage_report(clusters, split_of)
+    print(f"Images: {len(stems)}")
+    print(f"Near-duplicate clusters: {report['duplicate_clusters']}")
+    print(f"Clusters spanning train/valid: {report['leaking_clusters']} ({report['leaking_images']} images)")
+    for example in report["examples"]:
+        print("  " + ", ".join(example))
+
+
+if __name__ == "__main__":
+    main()
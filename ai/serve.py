@@ -0,0 +1,235 @@
+"""
+Async HTTP inference service around inference.analyze().
+
+Keeps one or more warm model instances and runs requests on a thread pool
+with one thread per model, so at most --models images are in the model at
+once and at most --max-queue more wait for one. Anything beyond that is
+answered immediately with 429 instead of piling up.
+
+Endpoints:
+  POST /analyze   multipart upload (field "image") or JSON {"image": "<path>"}
+                  optional query ?annotate=1&tile=1&timings=1
+                  -> the same JSON object `inference.py <image>` prints
+  GET  /health    200 once the models are loaded, 503 before that
+  GET  /metrics   request counters, latency percentiles, queue depth, cache stats
+
+Paths must be inside the project (e.g. backend/uploads), so the service
+cannot be used to read arbitrary files.
+
+Usage:
+  python serve.py [--host 127.0.0.1] [--port 8001] [--models 2] [--max-queue 16]
+"""
+
+import os
+import json
+import time
+import queue
+import asyncio
+import argparse
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import inference
+
+UPLOAD_CHUNK_BYTES = 256 * 1024
+LATENCY_WINDOW = 1000  # requests kept for the latency percentiles in /metrics
+PROJECT_ROOT = os.path.realpath(inference.project_root)
+
+
+class ModelPool:
+    """Warm model instances; a request checks one out for the duration of its inference."""
+
+    def __init__(self, size, model_path=None):
+        self.size = size
+        self.model_path = model_path or inference.backend_model_path()
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(inference.load_model(self.model_path))
+
+    @contextlib.contextmanager
+    def checkout(self):
+        model = self._idle.get()
+        try:
+            yield model
+        finally:
+            self._idle.put(model)
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.by_status = {}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, status, seconds):
+        self.requests += 1
+        self.by_status[status] = self.by_status.get(status, 0) + 1
+        self.latencies.append(seconds * 1000)
+
+    def snapshot(self):
+        ordered = sorted(self.latencies)
+
+        def pct(q):
+            return round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))], 2) if ordered else None
+
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "rejected_429": self.rejected,
+            "by_status": dict(self.by_status),
+            "latency_ms": {"p50": pct(50), "p95": pct(95), "p99": pct(99), "window": len(ordered)},
+        }
+
+
+class InferenceService:
+    def __init__(self, models=1, max_queue=16):
+        self.models = models
+        self.max_queue = max_queue
+        self.pool = None
+        self.load_error = None
+        self.executor = ThreadPoolExecutor(max_workers=models, thread_name_prefix="inference")
+        self.in_flight = 0  # requests admitted and not finished (only touched on the event loop)
+        self.metrics = Metrics()
+
+    @property
+    def capacity(self):
+        return self.models + self.max_queue
+
+    async def start(self, app):
+        # Load in the background so /health can answer "loading" meanwhile
+        self._loader = asyncio.get_running_loop().create_task(self.load_models())
+
+    async def load_models(self):
+        try:
+            self.pool = await asyncio.get_running_loop().run_in_executor(None, ModelPool, self.models)
+            print(f"{self.models} model(s) ready: {self.pool.model_path}")
+        except Exception as e:
+            self.load_error = str(e)
+            print(f"Model load failed: {e}")
+
+    async def stop(self, app):
+        self.executor.shutdown(wait=False)
+
+    def run(self, source, image_name, options):
+        with self.pool.checkout() as model:
+            return inference.analyze(source, image_name=image_name, model=model, **options)
+
+    async def read_upload(self, part):
+        """
+        Bytes of an uploaded file, read in chunks. client_max_size does not
+        apply to multipart parts, so the limit is enforced here (413 past it).
+        """
+        data = bytearray()
+        while True:
+            chunk = await part.read_chunk(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                return bytes(data)
+            data += chunk
+            if len(data) > inference.MAX_UPLOAD_BYTES:
+                raise web.HTTPRequestEntityTooLarge(
+                    max_size=inference.MAX_UPLOAD_BYTES, actual_size=len(data),
+                    text=json.dumps({"status": "error", "error": "Invalid image: File is too large "
+                                     f"(max {inference.MAX_UPLOAD_BYTES / 2**20:.0f} MB)."}),
+                    content_type="application/json")
+
+    async def read_request(self, request):
+        """(source, image_name) from a multipart upload or a JSON body with a path."""
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == "image":
+                    return await self.read_upload(part), part.filename
+            raise web.HTTPBadRequest(text='{"status": "error", "error": "No \\"image\\" field in upload"}',
+                                     content_type="application/json")
+
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        path = body.get("image") if isinstance(body, dict) else None
+        if not path:
+            raise web.HTTPBadRequest(text='{"status": "error", "error": "No image path provided"}',
+                                     content_type="application/json")
+        real = os.path.realpath(path)
+        if os.path.commonpath([real, PROJECT_ROOT]) != PROJECT_ROOT:
+            raise web.HTTPForbidden(text='{"status": "error", "error": "Path outside the project"}',
+                                    content_type="application/json")
+        return real, path
+
+    async def analyze(self, request):
+        if self.pool is None:
+            return web.json_response({"status": "error", "error": self.load_error or "Model loading"}, status=503)
+        if self.in_flight >= self.capacity:
+            self.metrics.rejected += 1
+            return web.json_response({"status": "error", "error": "Server busy, retry later"},
+                                     status=429, headers={"Retry-After": "1"})
+
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            source, image_name = await self.read_request(request)
+            options = {
+                "annotate": request.query.get("annotate") in ("1", "true"),
+                "tile": request.query.get("tile") in ("1", "true"),
+                "timings": True if request.query.get("timings") in ("1", "true") else None,
+            }
+            loop = asyncio.get_running_loop()
+            output = await loop.run_in_executor(self.executor, self.run, source, image_name, options)
+        finally:
+            self.in_flight -= 1
+        self.metrics.record(output.get("status", "unknown"), time.perf_counter() - start)
+        return web.json_response(output)
+
+    async def health(self, request):
+        ready = self.pool is not None
+        body = {
+            "status": "ok" if ready else "error" if self.load_error else "loading",
+            "backend": inference.BACKEND,
+            "model": self.pool.model_path if ready else None,
+            "models": self.models,
+        }
+        if self.load_error:
+            body["error"] = self.load_error
+        return web.json_response(body, status=200 if ready else 503)
+
+    async def metrics_handler(self, request):
+        return web.json_response({
+            **self.metrics.snapshot(),
+            "in_flight": self.in_flight,
+            "capacity": self.capacity,
+            "models": self.models,
+            "cache": inference._cache.stats() if inference._cache else None,
+        })
+
+
+def create_app(models=1, max_queue=16):
+    service = InferenceService(models, max_queue)
+    app = web.Application(client_max_size=inference.MAX_UPLOAD_BYTES)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    app.router.add_post("/analyze", service.analyze)
+    app.router.add_get("/health", service.health)
+    app.router.add_get("/metrics", service.metrics_handler)
+    app["service"] = service
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="HTTP inference service with a warm model pool.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--models", type=int, default=1, help="Warm model instances (= concurrent inferences)")
+    parser.add_argument("--max-queue", type=int, default=16, help="Requests allowed to wait before answering 429")
+    parser.add_argument("--backend", choices=sorted(inference.BACKENDS), default=inference.BACKEND)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    inference.BACKEND = args.backend
+    web.run_app(create_app(args.models, args.max_queue), host=args.host, port=args.port)
@@ -0,0 +1,195 @@
+"""
+Train on synthetic scenes generated on the fly instead of pre-rendered JPEGs.
+
+SyntheticSceneDataset plugs generate_data.render_scene into the ultralytics
+training loop: every __getitem__ composites a fresh scene and its YOLO labels
+in memory, so nothing is written to datasets/generated_train, no JPEG
+re-compression happens, and each epoch sees new, non-repeating data.
+Scenes are rendered inside the dataloader worker processes, which share the
+decoded grain atlas (copy-on-write after fork).
+
+Validation still runs on the real merged_dataset valid split.
+
+Usage:
+  python synthetic_stream.py --epochs 50 --scenes-per-epoch 2000 --workers 8
+"""
+
+import os
+import random
+import argparse
+
+import numpy as np
+import cv2
+from ultralytics import YOLO
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+
+import generate_data
+from train_v3 import fix_data_yaml
+
+
+class SyntheticSceneDataset(YOLODataset):
+    """
+    A YOLODataset whose samples are rendered on demand.
+
+    len() is the number of scenes per epoch; the index only names the sample.
+    Each call draws a new seed (from `seed`, the dataloader worker id and a
+    per-process counter, or from the OS when seed is None), so scenes never
+    repeat across epochs. The caller's `random` state is saved and restored
+    around rendering, so augmentation randomness is unaffected.
+    """
+
+    def __init__(self, *args, atlas=None, num_scenes=1000, grains_per_image=generate_data.GRAINS_PER_IMAGE,
+                 seed=None, **kwargs):
+        self.atlas = atlas
+        self.num_scenes = num_scenes
+        self.grains_per_image = grains_per_image
+        self.seed = seed
+        self._calls = 0
+        self._scratch = generate_data.CompositeScratch()
+        kwargs['cache'] = False  # Nothing to cache: every sample is new
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        return [f"synthetic_{i}.jpg" for i in range(self.num_scenes)]
+
+    def get_labels(self):
+        # Placeholders; real labels are produced with each scene
+        size = generate_data.IMG_SIZE
+        return [
+            dict(im_file=f, shape=(size, size), cls=np.zeros((0, 1), dtype=np.float32),
+                 bboxes=np.zeros((0, 4), dtype=np.float32), segments=[], keypoints=None,
+                 normalized=True, bbox_format="xywh")
+            for f in self.im_files
+        ]
+
+    def _next_seed(self, index):
+        if self.seed is None:
+            return int.from_bytes(os.urandom(8), 'little')
+        import torch.utils.data
+        info = torch.utils.data.get_worker_info()
+        worker_id = info.id if info else 0
+        self._calls += 1
+        return f"{self.seed}:{worker_id}:{self._calls}:{index}"
+
+    def render(self, index):
+        """Render one scene. Returns (bgr_image, cls (n,1), bboxes (n,4) normalized xywh)."""
+        state = random.getstate()
+        random.seed(self._next_seed(index))
+        try:
+            canvas, labels = generate_data.render_scene(self.atlas, self.grains_per_image, scratch=self._scratch)
+        finally:
+            random.setstate(state)
+        arr = np.array(labels, dtype=np.float32).reshape(-1, 5)
+        return canvas, arr[:, :1], arr[:, 1:]
+
+    def get_image_and_label(self, index):
+        im, cls, bboxes = self.render(index)
+        h0, w0 = im.shape[:2]
+        r = self.imgsz / max(h0, w0)
+        if r != 1:
+            im = cv2.resize(im, (min(round(w0 * r), self.imgsz), min(round(h0 * r), self.imgsz)),
+                            interpolation=cv2.INTER_LINEAR)
+        h, w = im.shape[:2]
+        label = dict(
+            im_file=self.im_files[index], cls=cls, bboxes=bboxes, segments=[], keypoints=None,
+            normalized=True, bbox_format="xywh",
+            img=im, ori_shape=(h0, w0), resized_shape=(h, w), ratio_pad=(h / h0, w / w0),
+        )
+        return self.update_labels_info(label)
+
+
+class SyntheticTrainer(DetectionTrainer):
+    """DetectionTrainer that trains on SyntheticSceneDataset and validates on the real valid split."""
+
+    # Set by train() before model.train(); ultralytics rejects unknown train() arguments
+    stream_config = {}
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        if mode != "train":
+            return super().build_dataset(img_path, mode, batch)
+        gs = max(int(self.model.stride.max() if self.model else 0), 32)
+        return SyntheticSceneDataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=True,
+            hyp=self.args,
+            rect=False,
+            stride=gs,
+            pad=0.0,
+            single_cls=self.args.single_cls or False,
+            classes=self.args.classes,
+            prefix=colorstr("synthetic: "),
+            task=self.args.task,
+            data=self.data,
+            **self.stream_config,
+        )
+
+    def plot_training_labels(self):
+        # Labels only exist per rendered scene, there is no static label set to plot
+        pass
+
+
+def train(args):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    data_yaml = fix_data_yaml(base_dir)
+    source_grains = generate_data.load_source_images(os.path.join(base_dir, args.source_dir))
+    atlas = generate_data.build_atlas(source_grains)
+    if not atlas:
+        print("No source images found!")
+        return
+
+    SyntheticTrainer.stream_config = dict(
+        atlas=atlas,
+        num_scenes=args.scenes_per_epoch,
+        grains_per_image=args.grains_per_image,
+        seed=args.seed,
+    )
+
+    print("=" * 60)
+    print("RICE QUALITY TRAINING - STREAMING SYNTHETIC DATA")
+    print("=" * 60)
+    print(f"Source grains: {len(atlas)}")
+    print(f"Scenes per epoch: {args.scenes_per_epoch} ({args.grains_per_image} grains each, rendered on the fly)")
+    print(f"Validation: {data_yaml}")
+    print(f"Model: {args.model}")
+    print("=" * 60)
+
+    model = YOLO(args.model)
+    model.train(
+        trainer=SyntheticTrainer,
+        data=data_yaml,
+        epochs=args.epochs,
+        imgsz=generate_data.IMG_SIZE,
+        batch=args.batch,
+        workers=args.workers,
+        name=args.name,
+        project=os.path.join(base_dir, 'runs/detect'),
+        pretrained=True,
+        optimizer='AdamW',
+        lr0=1e-3,
+        degrees=180,
+        flipud=0.5,
+        fliplr=0.5,
+        cache=False,
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train YOLOv8 on synthetic scenes rendered on the fly.")
+    parser.add_argument('--model', default='yolov8s.pt')
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Dataloader worker processes")
+    parser.add_argument('--scenes-per-epoch', type=int, default=2000)
+    parser.add_argument('--grains-per-image', type=int, default=generate_data.GRAINS_PER_IMAGE)
+    parser.add_argument('--seed', type=int, default=None, help="Fix for reproducible scene streams")
+    parser.add_argument('--source-dir', default=generate_data.SOURCE_DIR)
+    parser.add_argument('--name', default='rice_synthetic_stream')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    train(parse_args())
@@ -0,0 +1,255 @@
+"""
+Persistent decoded-image cache and dataloader profiling for CPU training.
+
+The same ~900 merged_dataset images are JPEG-decoded and resized by every
+dataloader worker in every epoch. ImageCache decodes them once, resized the
+way ultralytics' load_image does (long side = imgsz), into one memory-mapped
+uint8 array per split:
+
+  datasets/.image_cache/<split>_<imgsz>_<key>/images.npy   (N, imgsz, imgsz, 3), top-left aligned
+                                              shapes.npy   (N, 4) h0, w0, h, w
+                                              files.json   image paths in row order
+
+The key covers imgsz, the resize interpolation, the merge_manifest.json next
+to the trainer's data YAML (if any) and the size/mtime of every image, so
+re-merging or changing imgsz builds a new cache and an unchanged dataset
+reuses it across runs. Caches of other keys are left alone (another dataset
+may still use them) unless pruning is asked for (train_v3.py
+--prune-image-cache). Dataloader workers share the
+pages through the OS page cache instead of each holding decoded copies.
+
+LoaderProfiler is a set of ultralytics callbacks that split each epoch into
+time waiting for the dataloader and time in forward/backward/optimizer, and
+writes loader_profile.json into the run directory.
+
+Used by train_v3.py (--image-cache, --profile-loader).
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+
+BASE = Path(__file__).parent
+CACHE_ROOT = BASE / "datasets" / ".image_cache"
+MANIFEST_NAME = "merge_manifest.json"  # written by merge_datasets.py next to data.yaml
+
+
+def resize_like_ultralytics(im, imgsz, augment):
+    """Resize so the long side is imgsz, with the interpolation YOLODataset.load_image uses."""
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        w, h = min(round(w0 * r), imgsz), min(round(h0 * r), imgsz)
+        interp = cv2.INTER_LINEAR if (augment or r > 1) else cv2.INTER_AREA
+        im = cv2.resize(im, (w, h), interpolation=interp)
+    return im
+
+
+def cache_key(im_files, imgsz, augment, manifest=None):
+    digest = hashlib.sha1(f"{imgsz}|{'linear' if augment else 'area'}".encode())
+    if manifest is not None and Path(manifest).exists():
+        digest.update(Path(manifest).read_bytes())
+    for f in im_files:
+        st = os.stat(f)
+        digest.update(f"{f}|{st.st_size}|{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:12]
+
+
+class ImageCache:
+    """Read side of the memory-mapped cache; the array is opened lazily in each process."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.shapes = np.load(self.path / "shapes.npy")
+        files = json.loads((self.path / "files.json").read_text())
+        self.index = {f: i for i, f in enumerate(files)}
+        self._images = None
+
+    def __getstate__(self):
+        # Dataloader workers reopen the memmap instead of pickling the array
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.path / "images.npy", mmap_mode="r")
+        return self._images
+
+    def get(self, im_file):
+        """(image, (h0, w0), (h, w)) like YOLODataset.load_image, or None if the file is not cached."""
+        i = self.index.get(im_file)
+        if i is None:
+            return None
+        h0, w0, h, w = self.shapes[i].tolist()
+        return np.array(self.images[i, :h, :w]), (h0, w0), (h, w)
+
+    @classmethod
+    def build(cls, im_files, imgsz, augment, split, workers=8, manifest=None, prune=False):
+        """
+        Open the cache for these files, building it first if no matching cache exists.
+        With prune, other caches of the same split/imgsz (other keys) are deleted.
+        """
+        key = cache_key(im_files, imgsz, augment, manifest)
+        name = f"{split}_{imgsz}_{key}"
+        path = CACHE_ROOT / name
+        if prune and CACHE_ROOT.exists():
+            for old in CACHE_ROOT.glob(f"{split}_{imgsz}_*"):
+                if old.name != name:
+                    shutil.rmtree(old, ignore_errors=True)
+        if (path / "files.json").exists():
+            return cls(path)
+
+        start = time.perf_counter()
+        tmp = CACHE_ROOT / f".{name}.{os.getpid()}"
+        tmp.mkdir(parents=True, exist_ok=True)
+        images = np.lib.format.open_memmap(tmp / "images.npy", mode="w+", dtype=np.uint8,
+                                           shape=(len(im_files), imgsz, imgsz, 3))
+        shapes = np.zeros((len(im_files), 4), dtype=np.int32)
+
+        def fill(images, i):
+            im = cv2.imread(im_files[i])
+            if im is None:
+                raise FileNotFoundError(f"Image not found or unreadable: {im_files[i]}")
+            h0, w0 = im.shape[:2]
+            im = resize_like_ultralytics(im, imgsz, augment)
+            h, w = im.shape[:2]
+            images[i, :h, :w] = im
+            shapes[i] = (h0, w0, h, w)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(partial(fill, images), range(len(im_files))))
+        images.flush()
+        del images  # close the memmap before the directory is renamed
+        np.save(tmp / "shapes.npy", shapes)
+        (tmp / "files.json").write_text(json.dumps(list(im_files)))
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # Another process (e.g. a DDP rank) finished the same cache first; use theirs
+            if not (path / "files.json").exists():
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+            return cls(path)
+        size_gb = (path / "images.npy").stat().st_size / 1e9
+        print(f"{colorstr('image cache:')} {len(im_files)} {split} images decoded into {path} "
+              f"({size_gb:.2f} GB) in {time.perf_counter() - start:.1f}s")
+        return cls(path)
+
+
+class CachedYOLODataset(YOLODataset):
+    """YOLODataset that reads decoded, resized images from an ImageCache instead of decoding JPEGs."""
+
+    def __init__(self, *args, split="train", cache_workers=8, manifest=None, prune_cache=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.image_cache = ImageCache.build(self.im_files, self.imgsz, self.augment, split, cache_workers,
+                                            manifest=manifest, prune=prune_cache)
+
+    def load_image(self, i, rect_mode=True):
+        if self.ims[i] is not None or not rect_mode:
+            return super().load_image(i, rect_mode)
+        im, hw0, hw = self.image_cache.get(self.im_files[i])
+        if self.augment:
+            # Same mosaic buffer bookkeeping as YOLODataset.load_image
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, hw0, hw
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+        return im, hw0, hw
+
+
+class CachedTrainer(DetectionTrainer):
+    """DetectionTrainer whose train and val datasets read from ImageCache."""
+
+    prune_cache = False  # set by train_v3.py --prune-image-cache
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        gs = max(int(self.model.stride.max() if self.model else 0), 32)
+        return CachedYOLODataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=gs,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode}: "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0,
+            split=mode,
+            cache_workers=max(self.args.workers, 1),
+            manifest=Path(self.args.data).parent / MANIFEST_NAME,
+            prune_cache=self.prune_cache,
+        )
+
+
+class LoaderProfiler:
+    """
+    Per-epoch split of training time into dataloader wait vs compute.
+
+    data    : from the end of one batch (or the epoch start) until the next
+              batch is handed to the trainer, i.e. time the loop waited on
+              the dataloader
+    compute : from then until on_train_batch_end (forward, backward, optimizer)
+    """
+
+    def __init__(self):
+        self.epochs = []
+        self._mark = None
+        self._data = self._compute = 0.0
+        self._batches = 0
+
+    def on_train_epoch_start(self, trainer):
+        self._mark = time.perf_counter()
+        self._data = self._compute = 0.0
+        self._batches = 0
+
+    def on_train_batch_start(self, trainer):
+        now = time.perf_counter()
+        self._data += now - self._mark
+        self._mark = now
+
+    def on_train_batch_end(self, trainer):
+        now = time.perf_counter()
+        self._compute += now - self._mark
+        self._mark = now
+        self._batches += 1
+
+    def on_train_epoch_end(self, trainer):
+        total = self._data + self._compute
+        record = {
+            "epoch": trainer.epoch + 1,
+            "batches": self._batches,
+            "data_s": round(self._data, 2),
+            "compute_s": round(self._compute, 2),
+            "data_fraction": round(self._data / total, 3) if total else None,
+            "batch": trainer.batch_size,
+            "workers": trainer.args.workers,
+        }
+        self.epochs.append(record)
+        print(f"{colorstr('loader profile:')} epoch {record['epoch']} | data {record['data_s']}s | "
+              f"compute {record['compute_s']}s | waiting on data {record['data_fraction']:.0%}"
+              if total else f"{colorstr('loader profile:')} epoch {record['epoch']} | no batches")
+        (Path(trainer.save_dir) / "loader_profile.json").write_text(json.dumps(self.epochs, indent=2))
+
+    def attach(self, model):
+        for event in ("on_train_epoch_start", "on_train_batch_start", "on_train_batch_end", "on_train_epoch_end"):
+            model.add_callback(event, getattr(self, event))
@@ -1,5 +1,6 @@
 from ultralytics import YOLO
 import os
+import argparse
 
 def fix_data_yaml(base_dir):
     """Rewrite data.yaml with the correct absolute path for the current machine."""
@@ -18,7 +19,7 @@ names:
         f.write(content)
     return data_yaml
 
-def train():
+def train(args):
     base_dir = os.path.dirname(os.path.abspath(__file__))
     data_yaml = fix_data_yaml(base_dir)
 
@@ -30,15 +31,27 @@ def train():
     print(f"Dataset: 904 images (723 train / 181 val)")
     print(f"Classes: Full, Broken")
     print(f"Expected duration: 4-6 hours on CPU")
+    print(f"Batch: {args.batch} | Dataloader workers: {args.workers}")
+    print(f"Decoded image cache: {'on' if args.image_cache else 'off'} | Loader profiling: {'on' if args.profile_loader else 'off'}")
     print("=" * 60)
 
     model = YOLO('yolov8s.pt')
 
+    extra = {}
+    if args.image_cache:
+        from train_cache import CachedTrainer
+        CachedTrainer.prune_cache = args.prune_image_cache
+        extra['trainer'] = CachedTrainer
+    if args.profile_loader:
+        from train_cache import LoaderProfiler
+        LoaderProfiler().attach(model)
+
     results = model.train(
         data=data_yaml,
-        epochs=100,
-        imgsz=640,           # 640 is optimal — dataset images are smaller resolution
-        batch=8,
+        epochs=args.epochs,
+        imgsz=args.imgsz,    # 640 is optimal — dataset images are smaller resolution
+        batch=args.batch,
+        workers=args.workers,
         patience=30,         # Stop early if no improvement for 30 epochs
         name='rice_quality_v3',
         project=os.path.join(base_dir, 'runs/detect'),
@@ -61,6 +74,7 @@ def train():
         save=True,
         save_period=10,
         val=True,
+        **extra,
     )
 
     print("\n" + "=" * 60)
@@ -71,5 +85,19 @@ def train():
     print("Update inference.py MODEL_PATH to use this model.")
     print("=" * 60)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train YOLOv8-Small on the merged rice dataset.")
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=8, help="Dataloader worker processes")
+    parser.add_argument('--image-cache', action='store_true',
+                        help="Read decoded, resized images from a persistent memory-mapped cache (see train_cache.py)")
+    parser.add_argument('--prune-image-cache', action='store_true',
+                        help="With --image-cache, delete older caches of the same split and image size")
+    parser.add_argument('--profile-loader', action='store_true',
+                        help="Report dataloader wait vs compute time per epoch (loader_profile.json in the run dir)")
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    train()
+    train(parse_args())
@@ -0,0 +1,174 @@
+const { spawn } = require('child_process');
+const path = require('path');
+const fs = require('fs');
+const readline = require('readline');
+
+// Long-lived `inference.py --worker` process.
+// The model is loaded once; each request is one JSON line on stdin and
+// the matching result comes back as one JSON line on stdout (matched by id).
+
+const scriptPath = path.resolve(__dirname, '../../ai/inference.py');
+const venvPythonPath = path.resolve(__dirname, '../../ai/venv/bin/python');
+
+// Per-request limit (ms), including the model load on the first request.
+// A request that runs past it is rejected and the worker is restarted.
+const requestTimeoutMs = parseInt(process.env.INFERENCE_TIMEOUT_MS || '120000', 10);
+
+let child = null;
+let nextId = 1;
+const pending = new Map();
+
+function settle(id) {
+    const entry = pending.get(id);
+    if (entry) {
+        clearTimeout(entry.timer);
+        pending.delete(id);
+    }
+    return entry;
+}
+
+function failPending(message) {
+    for (const id of [...pending.keys()]) {
+        settle(id).reject(new Error(message));
+    }
+}
+
+// Drop the current worker: the next analyze() starts a fresh one.
+// Events from the old process are ignored once it is no longer `child`.
+function stopWorker(message) {
+    const proc = child;
+    child = null;
+    failPending(message);
+    if (proc) {
+        proc.kill();
+    }
+}
+
+function startWorker() {
+    const executable = fs.existsSync(venvPythonPath) ? venvPythonPath : 'python3';
+    console.log(`Starting AI worker: ${executable} ${scriptPath} --worker`);
+
+    const proc = spawn(executable, [scriptPath, '--worker']);
+    child = proc;
+    let stderr = '';
+
+    readline.createInterface({ input: proc.stdout }).on('line', (line) => {
+        if (proc !== child) {
+            return;
+        }
+        let message;
+        try {
+            message = JSON.parse(line);
+        } catch (e) {
+            return; // Ignore anything that is not a protocol line
+        }
+        if (message.id === undefined) {
+            if (message.status === 'ready') {
+                console.log('AI worker ready');
+            } else if (message.status === 'error') {
+                // The model failed to load, so every queued request would fail the same way
+                console.error(`AI worker failed to start: ${message.error}`);
+                stopWorker(message.error);
+            }
+            return;
+        }
+        const entry = settle(message.id);
+        if (!entry) {
+            return;
+        }
+        delete message.id;
+        entry.resolve(message);
+    });
+
+    proc.stderr.on('data', (data) => {
+        // Keep only the tail so a chatty worker cannot grow this forever
+        stderr = (stderr + data.toString()).slice(-4000);
+    });
+
+    // Writing to a worker that just died raises EPIPE here; without a
+    // listener that error would crash the server. 'close' fails the requests.
+    proc.stdin.on('error', (err) => {
+        console.error('AI worker stdin error:', err.message);
+    });
+
+    proc.on('close', (code) => {
+        console.error(`AI worker exited with code ${code}`);
+        if (stderr) {
+            console.error(`Stderr: ${stderr}`);
+        }
+        if (proc === child) {
+            stopWorker(`AI worker exited with code ${code}: ${stderr}`);
+        }
+    });
+
+    proc.on('error', (err) => {
+        console.error('Failed to start AI worker:', err);
+        if (proc === child) {
+            stopWorker(`Failed to start AI worker: ${err.message}`);
+        }
+    });
+}
+
+// With INFERENCE_URL set (e.g. http://127.0.0.1:8001), requests go to ai/serve.py
+// instead of a child process; a 429 from its bounded queue surfaces as an error.
+const inferenceUrl = process.env.INFERENCE_URL;
+
+// Failures map to the worker path's shapes: a rejected request (bad or too
+// large image, 4xx with an error body) resolves with {status: 'error', error},
+// while timeouts, 429/5xx and unreadable responses reject with an Error.
+async function analyzeOverHttp(imagePath) {
+    let response;
+    try {
+        response = await fetch(`${inferenceUrl.replace(/\/$/, '')}/analyze`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ image: imagePath }),
+            signal: AbortSignal.timeout(requestTimeoutMs),
+        });
+    } catch (err) {
+        if (err.name === 'TimeoutError') {
+            throw new Error(`Inference service timed out after ${requestTimeoutMs} ms`);
+        }
+        throw new Error(`Inference service unreachable: ${err.message}`);
+    }
+
+    let body = null;
+    if ((response.headers.get('content-type') || '').includes('application/json')) {
+        try {
+            body = await response.json();
+        } catch (err) {
+            body = null; // fall through to the status-based error below
+        }
+    }
+    if (response.ok && body) {
+        return body;
+    }
+    const reason = (body && body.error) || response.statusText;
+    if (body && body.status === 'error' && response.status >= 400 && response.status < 500 && response.status !== 429) {
+        return { status: 'error', error: reason };
+    }
+    throw new Error(`Inference service ${response.status}: ${reason}`);
+}
+
+// Analyze one image; resolves with the same JSON object `inference.py <image>` prints.
+exports.analyze = (imagePath) => {
+    if (inferenceUrl) {
+        return analyzeOverHttp(imagePath);
+    }
+    if (!child) {
+        startWorker();
+    }
+    const id = nextId++;
+    return new Promise((resolve, reject) => {
+        const timer = setTimeout(() => {
+            const entry = settle(id);
+            if (entry) {
+                entry.reject(new Error(`AI worker timed out after ${requestTimeoutMs} ms`));
+                // A hung worker would stall every request queued behind this one
+                stopWorker('AI worker restarted after a request timed out');
+            }
+        }, requestTimeoutMs);
+        pending.set(id, { resolve, reject, timer });
+        child.stdin.write(JSON.stringify({ id, image: imagePath }) + '\n');
+    });
+};